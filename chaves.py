@@ -0,0 +1,121 @@
+"""
+Codificação das chaves de documento da agenda.
+
+Todo documento de agendamento tem o ID "<AAAA-MM-DD>_<HH:MM>_<barbeiro>",
+seguido de "_BLOQUEADO" (horário seguinte de corte + barba) ou "_RESERVA"
+(reserva temporária). Este módulo é o único lugar que monta e lê essas chaves,
+usando tabelas pré-calculadas em vez de strftime/strptime a cada célula.
+"""
+from datetime import date, datetime
+from functools import lru_cache
+
+# Grade de horários (meia em meia hora). 07:00 e 07:30 só abrem no intervalo especial.
+HORARIOS = tuple(f"{h:02d}:{m:02d}" for h in range(7, 20) for m in (0, 30))
+HORARIOS_SDJ = HORARIOS[:2]
+HORARIOS_GRADE = HORARIOS[2:]  # 08:00 a 19:30, exibidos na tabela e no formulário
+INDICE_HORARIO = {horario: indice for indice, horario in enumerate(HORARIOS)}
+HORA_DO_HORARIO = {horario: int(horario[:2]) for horario in HORARIOS}
+MINUTOS_DO_HORARIO = {horario: int(horario[:2]) * 60 + int(horario[3:]) for horario in HORARIOS}
+
+# Tipos de documento e o sufixo de cada um no ID
+AGENDAMENTO = "AGENDAMENTO"
+BLOQUEADO = "BLOQUEADO"
+RESERVA = "RESERVA"
+TIPOS = (AGENDAMENTO, BLOQUEADO, RESERVA)
+SUFIXO_DO_TIPO = {AGENDAMENTO: "", BLOQUEADO: "_BLOQUEADO", RESERVA: "_RESERVA"}
+INDICE_TIPO = {tipo: indice for indice, tipo in enumerate(TIPOS)}
+
+
+def horario_seguinte(horario):
+    """Horário 30 minutos depois, ou None se passar do fim do expediente (20:00)."""
+    indice = INDICE_HORARIO[horario] + 1
+    return HORARIOS[indice] if indice < len(HORARIOS) else None
+
+
+@lru_cache(maxsize=1024)
+def _texto_da_data(ordinal):
+    return date.fromordinal(ordinal).isoformat()
+
+
+def chave_data(data):
+    """Prefixo 'AAAA-MM-DD' da chave para um date ou datetime."""
+    return _texto_da_data(data.toordinal())
+
+
+@lru_cache(maxsize=1024)
+def data_de_texto(texto):
+    """Converte 'dd/mm/aaaa' (formato exibido ao cliente) em date."""
+    dia, mes, ano = texto.split('/')
+    return date(int(ano), int(mes), int(dia))
+
+
+@lru_cache(maxsize=1024)
+def data_de_chave(prefixo):
+    """Converte o prefixo 'AAAA-MM-DD' da chave em datetime (como é salvo no campo 'data')."""
+    return datetime(int(prefixo[:4]), int(prefixo[5:7]), int(prefixo[8:10]))
+
+
+def chave_documento(data, horario, barbeiro, tipo=AGENDAMENTO):
+    """Monta o ID do documento. 'data' pode ser date/datetime ou o prefixo 'AAAA-MM-DD'."""
+    prefixo = data if isinstance(data, str) else chave_data(data)
+    return f"{prefixo}_{horario}_{barbeiro}{SUFIXO_DO_TIPO[tipo]}"
+
+
+def ler_chave_documento(doc_id):
+    """Separa o ID do documento em (prefixo da data, horário, barbeiro, tipo)."""
+    prefixo, horario, resto = doc_id[:10], doc_id[11:16], doc_id[17:]
+    for tipo in (BLOQUEADO, RESERVA):
+        sufixo = SUFIXO_DO_TIPO[tipo]
+        if resto.endswith(sufixo):
+            return prefixo, horario, resto[:-len(sufixo)], tipo
+    return prefixo, horario, resto, AGENDAMENTO
+
+
+class CodecDeHorarios:
+    """
+    Mapeia (data, horário, barbeiro, tipo) de uma unidade para um índice
+    inteiro e de volta. Os índices de um mesmo barbeiro e dia são contíguos,
+    então o horário seguinte é só índice + len(TIPOS).
+    """
+
+    def __init__(self, barbeiros):
+        self.barbeiros = tuple(barbeiros)
+        self.indice_barbeiro = {barbeiro: indice for indice, barbeiro in enumerate(self.barbeiros)}
+        # Somado ao índice de um agendamento, dá o do bloqueio/reserva no mesmo horário
+        self.deslocamento = dict(INDICE_TIPO)
+
+    def codificar(self, data, horario, barbeiro, tipo=AGENDAMENTO):
+        ordinal = data.toordinal() if not isinstance(data, str) else data_de_chave(data).toordinal()
+        indice = (ordinal * len(self.barbeiros) + self.indice_barbeiro[barbeiro]) * len(HORARIOS)
+        return (indice + INDICE_HORARIO[horario]) * len(TIPOS) + INDICE_TIPO[tipo]
+
+    def decodificar(self, indice):
+        """Retorna (date, horário, barbeiro, tipo)."""
+        indice, tipo = divmod(indice, len(TIPOS))
+        indice, horario = divmod(indice, len(HORARIOS))
+        ordinal, barbeiro = divmod(indice, len(self.barbeiros))
+        return date.fromordinal(ordinal), HORARIOS[horario], self.barbeiros[barbeiro], TIPOS[tipo]
+
+    def indexar(self, documentos):
+        """
+        Converte {ID do documento: dados} (a consulta do dia) em {índice: dados},
+        lendo cada chave uma única vez. Documentos de barbeiros fora da unidade
+        ou fora da grade ficam de fora.
+        """
+        indexados = {}
+        for doc_id, dados in documentos.items():
+            prefixo, horario, barbeiro, tipo = ler_chave_documento(doc_id)
+            if barbeiro in self.indice_barbeiro and horario in INDICE_HORARIO:
+                indexados[self.codificar(prefixo, horario, barbeiro, tipo)] = dados
+        return indexados
+
+    def chave(self, indice):
+        """ID do documento correspondente ao índice (só para gravar no Firestore)."""
+        data, horario, barbeiro, tipo = self.decodificar(indice)
+        return chave_documento(data, horario, barbeiro, tipo)
+
+    def seguinte(self, indice):
+        """Índice do horário seguinte (mesmo barbeiro, dia e tipo), ou None no fim do dia."""
+        if (indice // len(TIPOS)) % len(HORARIOS) == len(HORARIOS) - 1:
+            return None
+        return indice + len(TIPOS)
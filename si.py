@@ -2,7 +2,8 @@ import streamlit as st
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
 from google.cloud.firestore_v1.field_path import FieldPath
-from datetime import datetime, timedelta
+from google.cloud.firestore_v1.base_query import FieldFilter
+from datetime import datetime, timedelta, timezone
 import smtplib
 from email.mime.text import MIMEText
 import json
@@ -14,6 +15,16 @@ import time
 from PIL import Image, ImageDraw, ImageFont
 import io
 import os # <-- MÓDULO ADICIONADO
+import sqlite3
+import threading
+import cProfile
+import pstats
+import functools
+import hashlib
+import uuid
+import itertools
+import chaves
+from chaves import chave_documento, ler_chave_documento, BLOQUEADO, RESERVA
 
 # --- 1. CAMINHO SEGURO PARA O ÍCONE (NOVO BLOCO DE CÓDIGO) ---
 # Documentação: Esta seção cria um caminho completo e seguro para a pasta 'static',
@@ -35,6 +46,83 @@ st.set_page_config(
     page_icon=favicon # <-- O ÍCONE AGORA É CARREGADO DE FORMA SEGURA
 )
 
+# --- MODO ADMINISTRADOR E PERFIL DE EXECUÇÃO ---
+# O modo administrador é liberado abrindo a página com ?admin=<ADMIN_TOKEN>.
+# Com ?admin=<ADMIN_TOKEN>&perfil=1 esta execução do script roda dentro do
+# cProfile e termina com um relatório das funções mais caras e do tempo gasto
+# em Firestore, tabela, imagem e e-mail. PERFILAR_EXECUCAO=1 no ambiente vale
+# para uma única execução por processo: a primeira em modo administrador.
+# Com PERFIL_DIRETORIO definido, o perfil também é salvo em arquivo .prof.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+modo_admin = bool(ADMIN_TOKEN) and st.query_params.get('admin') == ADMIN_TOKEN
+
+@st.cache_resource
+def obter_perfil_do_ambiente():
+    """Se o perfil pedido por PERFILAR_EXECUCAO ainda não foi usado neste processo."""
+    return {'pendente': os.environ.get('PERFILAR_EXECUCAO') == '1', 'lock': threading.Lock()}
+
+def consumir_perfil_do_ambiente():
+    estado = obter_perfil_do_ambiente()
+    with estado['lock']:
+        pendente, estado['pendente'] = estado['pendente'], False
+    return pendente
+
+perfil_ativo = modo_admin and (st.query_params.get('perfil') == '1' or consumir_perfil_do_ambiente())
+
+TEMPOS_EXECUCAO = {}  # categoria -> segundos somados nesta execução
+inicio_execucao = time.perf_counter()
+perfilador = None
+if perfil_ativo:
+    perfilador = cProfile.Profile()
+    perfilador.enable()
+
+def registrar_tempo(categoria, segundos):
+    TEMPOS_EXECUCAO[categoria] = TEMPOS_EXECUCAO.get(categoria, 0.0) + segundos
+
+def cronometrar(categoria):
+    """Decorador que soma o tempo de parede da função à categoria informada."""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envoltorio(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                registrar_tempo(categoria, time.perf_counter() - inicio)
+        return envoltorio
+    return decorador
+
+def exibir_relatorio_de_perfil():
+    """
+    Encerra o perfil desta execução e mostra o relatório. Chamada no fim do
+    script e antes dos st.rerun(); execuções interrompidas por st.stop() não
+    geram relatório.
+    """
+    global perfilador
+    if perfilador is None or not modo_admin:
+        return
+    perfilador.disable()
+    total = time.perf_counter() - inicio_execucao
+
+    with st.expander("Perfil desta execução", expanded=True):
+        linhas = [{"Etapa": categoria, "Segundos": round(segundos, 3)} for categoria, segundos in TEMPOS_EXECUCAO.items()]
+        linhas.append({"Etapa": "Outros", "Segundos": round(total - sum(TEMPOS_EXECUCAO.values()), 3)})
+        linhas.append({"Etapa": "Total da execução", "Segundos": round(total, 3)})
+        st.table(pd.DataFrame(linhas))
+
+        saida = io.StringIO()
+        pstats.Stats(perfilador, stream=saida).sort_stats('cumulative').print_stats(25)
+        st.code(saida.getvalue())
+        st.caption(resumo_metricas_fila())
+
+        diretorio_perfil = os.environ.get('PERFIL_DIRETORIO')
+        if diretorio_perfil:
+            caminho = os.path.join(diretorio_perfil, f"perfil_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+            perfilador.dump_stats(caminho)
+            st.caption(f"Perfil salvo em {caminho}")
+
+    perfilador = None
+
 @st.cache_resource
 def initialize_firebase():
     """
@@ -70,9 +158,93 @@ except Exception as e:
     st.error(f"Erro ao carregar as credenciais de e-mail: {e}")
     st.stop()
 
+# --- CLIENTES DO FIRESTORE ---
+# Conjunto de clientes compartilhado pelas sessões do processo, cada um com o
+# próprio canal gRPC, para que sessões simultâneas não fiquem na fila de uma
+# única conexão. O keepalive mantém os canais abertos entre os acessos e o
+# ping de aquecimento paga o custo da conexão na inicialização, não no
+# primeiro cliente. Cada sessão fica presa a um cliente do conjunto.
+FIRESTORE_CANAIS = max(int(os.environ.get('FIRESTORE_CANAIS', '2')), 1)
+FIRESTORE_KEEPALIVE_MS = int(os.environ.get('FIRESTORE_KEEPALIVE_MS', '60000'))
+
+def _criar_cliente_firestore(indice, saude):
+    """
+    Cria um cliente com canal gRPC próprio. Se não der para trocar o canal
+    (a troca usa atributos internos do SDK), fica com o canal padrão do cliente.
+    """
+    app = firebase_admin.get_app()
+    cliente = firestore.Client(project=app.project_id, credentials=app.credential.get_credential())
+    try:
+        from google.cloud.firestore_v1.services.firestore import client as firestore_client
+        from google.cloud.firestore_v1.services.firestore.transports import grpc as firestore_grpc
+
+        opcoes = [
+            ("grpc.keepalive_time_ms", FIRESTORE_KEEPALIVE_MS),
+            ("grpc.keepalive_timeout_ms", 20000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            # Canais distintos não compartilham a mesma conexão TCP
+            ("grpc.use_local_subchannel_pool", 1),
+        ]
+        canal = firestore_grpc.FirestoreGrpcTransport.create_channel(
+            cliente._target, credentials=cliente._credentials, options=opcoes
+        )
+        transporte = firestore_grpc.FirestoreGrpcTransport(host=cliente._target, channel=canal)
+        cliente._firestore_api_internal = firestore_client.FirestoreClient(transport=transporte)
+        # Se o SDK renomear o atributo, a atribuição acima não tem efeito: confere
+        # que o cliente usa mesmo o canal novo antes de reportar a saúde dele
+        if cliente._firestore_api._transport.grpc_channel is not canal:
+            canal.close()
+            raise RuntimeError("o cliente não adotou o canal configurado")
+        canal.subscribe(lambda estado: saude[indice].update(estado=estado.name), try_to_connect=True)
+    except Exception as e:
+        print(f"Canal gRPC padrão no cliente {indice} do Firestore: {e}")
+        saude[indice]['estado'] = "padrão"
+
+    # Ping de aquecimento: a leitura de um documento inexistente abre a conexão
+    inicio = time.perf_counter()
+    try:
+        cliente.collection('_aquecimento').document('ping').get(timeout=10)
+        saude[indice]['aquecimento_ms'] = round((time.perf_counter() - inicio) * 1000, 1)
+    except Exception as e:
+        print(f"Falha no aquecimento do cliente {indice} do Firestore: {e}")
+        saude[indice]['aquecimento_ms'] = None
+    return cliente
+
+@st.cache_resource
+def obter_clientes_firestore():
+    """Cria e aquece os clientes do Firestore uma única vez por processo."""
+    saude = [{'estado': "IDLE", 'aquecimento_ms': None, 'sessoes_atribuidas': 0} for _ in range(FIRESTORE_CANAIS)]
+    clientes = [_criar_cliente_firestore(indice, saude) for indice in range(FIRESTORE_CANAIS)]
+    return {'clientes': clientes, 'saude': saude, 'proximo': itertools.count(), 'lock': threading.Lock()}
+
+def cliente_firestore_da_sessao():
+    """Cliente do conjunto usado por esta sessão (distribuição em rodízio)."""
+    conjunto = obter_clientes_firestore()
+    if 'canal_firestore' not in st.session_state:
+        with conjunto['lock']:
+            indice = next(conjunto['proximo']) % len(conjunto['clientes'])
+            conjunto['saude'][indice]['sessoes_atribuidas'] += 1
+        st.session_state.canal_firestore = indice
+    return conjunto['clientes'][st.session_state.canal_firestore]
+
+def resumo_saude_firestore():
+    """
+    Estado de cada canal, latência do aquecimento e sessões atribuídas desde
+    o início do processo (o Streamlit não avisa quando uma sessão termina).
+    """
+    conjunto = obter_clientes_firestore()
+    return pd.DataFrame([
+        {'Canal': indice, 'Estado': saude['estado'], 'Aquecimento (ms)': saude['aquecimento_ms'], 'Sessões atribuídas': saude['sessoes_atribuidas']}
+        for indice, saude in enumerate(conjunto['saude'])
+    ])
+
 initialize_firebase() 
 # Agora, obtém a referência do banco de dados de forma segura
-db = firestore.client() 
+try:
+    db = cliente_firestore_da_sessao()
+except Exception as e:
+    print(f"Erro ao criar os clientes do Firestore, usando o cliente padrão: {e}")
+    db = firestore.client()
 
 st.markdown(
     """
@@ -129,14 +301,126 @@ servicos = {
 # Lista de serviços para exibição
 lista_servicos = servicos
 
-barbeiros = ["Aluizio", "Lucas Borges"]
+# Unidades e barbeiros definidos como dados.
+# Cada unidade guarda os agendamentos na sua própria coleção, então a consulta
+# do dia e a tabela só enxergam a equipe daquela unidade. A unidade original
+# continua na coleção 'agendamentos' para não perder o histórico.
+UNIDADES_PADRAO = [
+    {
+        "id": "lucas_borges",
+        "nome": "Barbearia Lucas Borges",
+        "colecao": "agendamentos",
+        "barbeiros": [
+            {"nome": "Aluizio", "visagismo": False, "horarios_fechados_semana": [], "almoco": [12, 13]},
+            {"nome": "Lucas Borges", "visagismo": True, "horarios_fechados_semana": ["08:00"], "almoco": [12, 13]},
+        ],
+    },
+]
+
+def carregar_unidades():
+    """
+    Carrega as unidades da variável de ambiente 'unidades_json' (mesmo formato
+    de UNIDADES_PADRAO). Sem a variável, usa apenas a unidade original.
+    Unidades novas sem 'colecao' ficam em 'unidades/<id>/agendamentos'.
+    """
+    unidades_json = os.environ.get('unidades_json')
+    if not unidades_json:
+        return UNIDADES_PADRAO
+
+    try:
+        unidades = json.loads(unidades_json)
+        if not isinstance(unidades, list) or not unidades:
+            raise ValueError("esperada uma lista com pelo menos uma unidade")
+        ids_vistos = set()
+        for unidade in unidades:
+            if not isinstance(unidade, dict) or not unidade.get("id"):
+                raise ValueError("cada unidade deve ser um objeto com 'id'")
+            if unidade["id"] in ids_vistos:
+                raise ValueError(f"unidade '{unidade['id']}' repetida")
+            ids_vistos.add(unidade["id"])
+            if not isinstance(unidade.get("barbeiros"), list) or not unidade["barbeiros"]:
+                raise ValueError(f"unidade '{unidade['id']}' sem barbeiros")
+            if not all(isinstance(barbeiro, dict) and barbeiro.get("nome") for barbeiro in unidade["barbeiros"]):
+                raise ValueError(f"unidade '{unidade['id']}': cada barbeiro deve ser um objeto com 'nome'")
+            unidade.setdefault("nome", unidade["id"])
+            unidade.setdefault("colecao", f"unidades/{unidade['id']}/agendamentos")
+            for barbeiro in unidade["barbeiros"]:
+                barbeiro.setdefault("visagismo", False)
+                barbeiro.setdefault("horarios_fechados_semana", [])
+                barbeiro.setdefault("almoco", [12, 13])
+        return unidades
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        st.error(f"Configuração de unidades inválida em 'unidades_json': {e}")
+        st.stop()
+
+UNIDADES = carregar_unidades()
+UNIDADES_POR_ID = {unidade["id"]: unidade for unidade in UNIDADES}
+UNIDADE_PADRAO_ID = UNIDADES[0]["id"]
+# Codec das chaves de cada unidade (índices inteiros por data, horário, barbeiro e tipo)
+CODEC_POR_UNIDADE = {
+    unidade["id"]: chaves.CodecDeHorarios(barbeiro["nome"] for barbeiro in unidade["barbeiros"])
+    for unidade in UNIDADES
+}
+
+def colecao_agendamentos(unidade_id=UNIDADE_PADRAO_ID):
+    """Retorna a coleção de agendamentos da unidade."""
+    return db.collection(UNIDADES_POR_ID[unidade_id]["colecao"])
+
+# Cores de fundo e do texto de cada status da tabela de disponibilidade
+CORES_STATUS = {
+    "Disponível": ("forestgreen", "white"),
+    "Ocupado": ("firebrick", "white"),
+    "Indisponível": ("#808080", "white"),
+    "SDJ": ("#696969", "white"),
+    "Almoço": ("orange", "black"),
+    "Fechado": ("#A9A9A9", "black"),
+    "Reservado": ("#DAA520", "black"),
+}
+
+def eh_intervalo_especial(data_obj):
+    """Período de julho (10 a 19) com horário estendido, sem almoço e com domingo aberto."""
+    return data_obj.month == 7 and 10 <= data_obj.day <= 19
+
+def motivo_indisponibilidade(barbeiro, data_obj, horario):
+    """
+    Aplica as regras fixas da agenda para o barbeiro (dados da unidade) e
+    retorna o status a exibir ("SDJ", "Fechado", "Indisponível" ou "Almoço"),
+    ou None se o horário pode ser agendado.
+    """
+    if eh_intervalo_especial(data_obj):
+        return None
+
+    dia_da_semana = data_obj.weekday()
+    if horario in chaves.HORARIOS_SDJ:
+        return "SDJ"
+    if dia_da_semana == 6:
+        return "Fechado"
+    if dia_da_semana < 5:
+        if horario in barbeiro["horarios_fechados_semana"]:
+            return "Indisponível"
+        if chaves.HORA_DO_HORARIO[horario] in barbeiro["almoco"]:
+            return "Almoço"
+    return None
+
+def ordenar_barbeiros_por_carga(candidatos, agendamentos_do_dia):
+    """
+    Ordena os barbeiros do menos para o mais ocupado no dia, para que o
+    "Sem preferência" distribua os clientes entre a equipe. Empates são sorteados.
+    """
+    carga = {b: 0 for b in candidatos}
+    for dados in agendamentos_do_dia.values():
+        b = dados.get('barbeiro')
+        if b in carga and dados.get('nome') not in ('Fechado', 'RESERVA'):
+            carga[b] += 1
+    return sorted(candidatos, key=lambda b: (carga[b], random.random()))
 
 # Função para enviar e-mail
+@cronometrar("E-mail (enviar_email)")
 def enviar_email(assunto, mensagem):
     # Proteção extra para caso as credenciais não carreguem
     if not EMAIL or not SENHA:
         st.warning("Credenciais de e-mail não configuradas. E-mail não enviado.")
-        return
+        return False
     try:
         msg = MIMEText(mensagem)
         msg['Subject'] = assunto
@@ -147,31 +431,37 @@ def enviar_email(assunto, mensagem):
             server.starttls()
             server.login(EMAIL, SENHA)  # Login usando as credenciais do e-mail
             server.sendmail(EMAIL, EMAIL, msg.as_string())
+        return True
     except Exception as e:
         st.error(f"Erro ao enviar e-mail: {e}")
+        return False
 
 # SUBSTITUA A FUNÇÃO INTEIRA
-def salvar_agendamento(data_str, horario, nome, telefone, servicos, barbeiro):
+@cronometrar("Firestore")
+def salvar_agendamento(data_str, horario, nome, telefone, servicos, barbeiro, unidade_id=UNIDADE_PADRAO_ID, id_sessao=None):
     if not db:
         st.error("Firestore não inicializado.")
         return False
 
     try:
         # Converte a data string (que vem do formulário) para um objeto datetime
-        data_obj = datetime.strptime(data_str, '%d/%m/%Y')
+        data_obj = datetime.combine(chaves.data_de_texto(data_str), datetime.min.time())
         
         # Cria o ID do documento no formato correto YYYY-MM-DD
-        data_para_id = data_obj.strftime('%Y-%m-%d')
-        chave_agendamento = f"{data_para_id}_{horario}_{barbeiro}"
-        agendamento_ref = db.collection('agendamentos').document(chave_agendamento)
+        chave_agendamento = chave_documento(data_obj, horario, barbeiro)
+        agendamento_ref = colecao_agendamentos(unidade_id).document(chave_agendamento)
+        reserva_ref = colecao_agendamentos(unidade_id).document(chave_documento(data_obj, horario, barbeiro, RESERVA))
         
         # Esta é a parte que você perguntou, agora dentro da função principal
         @firestore.transactional
         def update_in_transaction(transaction, doc_ref):
             doc = doc_ref.get(transaction=transaction)
+            reserva = reserva_ref.get(transaction=transaction)
             if doc.exists:
                 # Se o documento já existe, a transação falha para evitar agendamento duplo
                 raise ValueError("Horário já ocupado por outra pessoa.")
+            if reserva.exists and reserva_ativa(reserva.to_dict(), id_sessao):
+                raise ValueError("Horário reservado por outro cliente. Tente novamente em alguns minutos ou escolha outro horário.")
             
             # Se o horário estiver livre, a transação define os novos dados
             transaction.set(doc_ref, {
@@ -183,6 +473,9 @@ def salvar_agendamento(data_str, horario, nome, telefone, servicos, barbeiro):
                 'barbeiro': barbeiro,
                 'timestamp': firestore.SERVER_TIMESTAMP
             })
+            # A reserva temporária (se houver) vira o agendamento
+            if reserva.exists:
+                transaction.delete(reserva_ref)
         
         # Executa a transação
         transaction = db.transaction()
@@ -198,7 +491,8 @@ def salvar_agendamento(data_str, horario, nome, telefone, servicos, barbeiro):
         return False
 
 # Função para cancelar agendamento no Firestore
-def cancelar_agendamento(doc_id, telefone_cliente):
+@cronometrar("Firestore")
+def cancelar_agendamento(doc_id, telefone_cliente, unidade_id=UNIDADE_PADRAO_ID):
     """
     Cancela um agendamento no Firestore de forma segura.
     """
@@ -207,7 +501,7 @@ def cancelar_agendamento(doc_id, telefone_cliente):
         return None
     
     try:
-        doc_ref = db.collection('agendamentos').document(doc_id)
+        doc_ref = colecao_agendamentos(unidade_id).document(doc_id)
         doc = doc_ref.get()
 
         # PASSO CHAVE: VERIFICA SE O DOCUMENTO EXISTE ANTES DE TUDO
@@ -225,6 +519,7 @@ def cancelar_agendamento(doc_id, telefone_cliente):
 
         # Se tudo deu certo, deleta e retorna os dados
         doc_ref.delete()
+        remover_do_espelho(unidade_id, doc_id)
         return agendamento_data
 
     except Exception as e:
@@ -233,7 +528,8 @@ def cancelar_agendamento(doc_id, telefone_cliente):
 
 # no seu arquivo si (9).py
 
-def desbloquear_horario(data_para_id, horario, barbeiro):
+@cronometrar("Firestore")
+def desbloquear_horario(data_para_id, horario, barbeiro, unidade_id=UNIDADE_PADRAO_ID):
     """
     Desbloqueia um horário usando a data já no formato correto (YYYY-MM-DD).
     """
@@ -244,8 +540,8 @@ def desbloquear_horario(data_para_id, horario, barbeiro):
     # A função agora recebe a data JÁ no formato YYY-MM-DD, então não precisa converter.
     # As linhas que causavam o erro foram removidas.
     
-    chave_bloqueio = f"{data_para_id}_{horario}_{barbeiro}_BLOQUEADO"
-    agendamento_ref = db.collection('agendamentos').document(chave_bloqueio)
+    chave_bloqueio = chave_documento(data_para_id, horario, barbeiro, BLOQUEADO)
+    agendamento_ref = colecao_agendamentos(unidade_id).document(chave_bloqueio)
     
     try:
         # Tenta apagar o documento de bloqueio diretamente.
@@ -255,22 +551,382 @@ def desbloquear_horario(data_para_id, horario, barbeiro):
 
     except Exception as e:
         st.error(f"Erro ao tentar desbloquear o horário seguinte: {e}")
+    else:
+        remover_do_espelho(unidade_id, chave_bloqueio)
+
+# --- ESPELHO LOCAL EM SQLITE (OPCIONAL) ---
+# Cópia somente leitura das coleções de agendamentos, ativada pela variável de
+# ambiente 'ESPELHO_SQLITE' (caminho do arquivo). As gravações continuam indo
+# direto para o Firestore, pelas transações de sempre; o espelho só atende as
+# leituras (tabela do dia e consultas por período, barbeiro ou telefone).
+ESPELHO_SQLITE = os.environ.get('ESPELHO_SQLITE')
+# Janela relida antes da marca d'água, para não perder transações confirmadas fora de ordem
+ESPELHO_SOBREPOSICAO = timedelta(seconds=60)
+# Intervalo entre as reconciliações completas dos dias a partir de hoje
+ESPELHO_RECONCILIACAO_SEG = int(os.environ.get('ESPELHO_RECONCILIACAO_SEG', '300'))
+# Intervalo mínimo entre duas sincronizações incrementais da mesma unidade
+ESPELHO_INTERVALO_SEG = float(os.environ.get('ESPELHO_INTERVALO_SEG', '5'))
+ESPELHO_TAMANHO_PAGINA = 500
+
+@st.cache_resource
+def obter_espelho():
+    """
+    Abre (criando, se preciso) o banco SQLite do espelho. A conexão é
+    compartilhada entre as sessões, por isso vem acompanhada de um lock.
+    """
+    conn = sqlite3.connect(ESPELHO_SQLITE, check_same_thread=False)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS agendamentos (
+            unidade TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            horario TEXT,
+            barbeiro TEXT,
+            telefone TEXT,
+            dados TEXT NOT NULL,
+            arquivado INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (unidade, doc_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_agendamentos_data ON agendamentos (unidade, data);
+        CREATE INDEX IF NOT EXISTS idx_agendamentos_barbeiro ON agendamentos (unidade, barbeiro, data);
+        CREATE INDEX IF NOT EXISTS idx_agendamentos_telefone ON agendamentos (telefone);
+        CREATE TABLE IF NOT EXISTS sincronizacao (
+            unidade TEXT PRIMARY KEY,
+            ultimo_timestamp TEXT,
+            ultimo_doc_id TEXT,
+            ultima_reconciliacao REAL NOT NULL DEFAULT 0
+        );
+    """)
+    # Espelhos criados antes do arquivamento não têm a coluna 'arquivado'
+    colunas = [coluna[1] for coluna in conn.execute("PRAGMA table_info(agendamentos)")]
+    if 'arquivado' not in colunas:
+        conn.execute("ALTER TABLE agendamentos ADD COLUMN arquivado INTEGER NOT NULL DEFAULT 0")
+    return conn, threading.Lock()
+
+def _normalizar_telefone(telefone):
+    return (telefone or "").replace(" ", "").replace("-", "")
+
+def _gravar_no_espelho(conn, unidade_id, doc):
+    dados = doc.to_dict()
+    conn.execute(
+        "INSERT OR REPLACE INTO agendamentos (unidade, doc_id, data, horario, barbeiro, telefone, dados) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            unidade_id,
+            doc.id,
+            doc.id[:10],  # O ID sempre começa com a data no formato YYYY-MM-DD
+            dados.get('horario'),
+            dados.get('barbeiro'),
+            _normalizar_telefone(dados.get('telefone')),
+            json.dumps(dados, default=lambda valor: valor.isoformat()),
+        ),
+    )
+    return dados
+
+def _ler_dados_do_espelho(dados_json):
+    dados = json.loads(dados_json)
+    for campo in ('data', 'timestamp', 'expira_em'):
+        if isinstance(dados.get(campo), str):
+            dados[campo] = datetime.fromisoformat(dados[campo])
+    return dados
+
+@st.cache_resource
+def obter_controle_de_sincronizacao():
+    """Momento da última sincronização e lock de sincronização de cada unidade."""
+    return {'ultima': {}, 'locks': {}, 'lock': threading.Lock()}
+
+def sincronizar_espelho(unidade_id=UNIDADE_PADRAO_ID):
+    """
+    Atualiza o espelho da unidade de forma incremental, no máximo uma vez a
+    cada ESPELHO_INTERVALO_SEG por processo.
+
+    Na primeira vez copia a coleção inteira. Depois busca só os documentos com
+    'timestamp' depois da marca d'água (timestamp + ID do último documento
+    gravado), retomando com start_after nesse par; só a janela de
+    ESPELHO_SOBREPOSICAO antes da marca é relida, para captar confirmações
+    atrasadas. A cada ESPELHO_RECONCILIACAO_SEG relê os dias a partir
+    de hoje para captar exclusões e documentos criados sem 'timestamp'
+    (por exemplo, horários fechados pelo console).
+
+    As leituras no Firestore acontecem fora do lock do espelho, que só é
+    tomado para gravar no SQLite; as consultas das outras sessões não esperam
+    pela rede. Enquanto uma sessão sincroniza a unidade, as demais leem o
+    espelho como está (só a carga inicial é aguardada).
+    """
+    conn, lock = obter_espelho()
+    controle = obter_controle_de_sincronizacao()
+    ultima_sincronizacao = controle['ultima'].get(unidade_id)
+    if ultima_sincronizacao is not None and time.time() - ultima_sincronizacao < ESPELHO_INTERVALO_SEG:
+        return
+
+    with controle['lock']:
+        lock_da_unidade = controle['locks'].setdefault(unidade_id, threading.Lock())
+    if not lock_da_unidade.acquire(blocking=ultima_sincronizacao is None):
+        return
+
+    try:
+        colecao = colecao_agendamentos(unidade_id)
+        with lock:
+            linha = conn.execute(
+                "SELECT ultimo_timestamp, ultimo_doc_id, ultima_reconciliacao FROM sincronizacao WHERE unidade = ?",
+                (unidade_id,),
+            ).fetchone()
+        ultimo_timestamp, ultimo_doc_id, ultima_reconciliacao = linha or (None, None, 0)
+        agora = time.time()
+
+        if linha is None:
+            # Carga inicial: copia tudo e parte do maior timestamp encontrado
+            docs = list(colecao.stream())
+            maior_timestamp = None
+            with lock:
+                for doc in docs:
+                    dados = _gravar_no_espelho(conn, unidade_id, doc)
+                    ts = dados.get('timestamp')
+                    # Mesma ordem da consulta incremental: timestamp e, no empate, ID
+                    if ts and (maior_timestamp is None or (ts, doc.id) > (maior_timestamp, ultimo_doc_id)):
+                        maior_timestamp, ultimo_doc_id = ts, doc.id
+                conn.commit()
+            ultimo_timestamp = maior_timestamp.isoformat() if maior_timestamp else None
+            ultima_reconciliacao = agora
+        else:
+            if ultimo_timestamp:
+                # Janela de sobreposição: só o que pode ter sido confirmado fora de ordem
+                marca = datetime.fromisoformat(ultimo_timestamp)
+                docs = list(colecao.where(filter=FieldFilter('timestamp', '>=', marca - ESPELHO_SOBREPOSICAO))
+                                   .where(filter=FieldFilter('timestamp', '<=', marca))
+                                   .stream())
+                with lock:
+                    for doc in docs:
+                        _gravar_no_espelho(conn, unidade_id, doc)
+                    conn.commit()
+
+            # Documentos novos: retoma depois do par (timestamp, ID) da marca d'água
+            consulta = colecao.order_by('timestamp') \
+                              .order_by(FieldPath.document_id()) \
+                              .limit(ESPELHO_TAMANHO_PAGINA)
+            while True:
+                pagina = consulta
+                if ultimo_timestamp:
+                    pagina = consulta.start_after({
+                        'timestamp': datetime.fromisoformat(ultimo_timestamp),
+                        '__name__': colecao.document(ultimo_doc_id),
+                    })
+                docs = list(pagina.stream())
+                with lock:
+                    for doc in docs:
+                        dados = _gravar_no_espelho(conn, unidade_id, doc)
+                        ultimo_timestamp, ultimo_doc_id = dados['timestamp'].isoformat(), doc.id
+                    conn.commit()
+                if len(docs) < ESPELHO_TAMANHO_PAGINA:
+                    break
+
+            if agora - ultima_reconciliacao >= ESPELHO_RECONCILIACAO_SEG:
+                hoje = chaves.chave_data(datetime.today())
+                docs = list(colecao.order_by(FieldPath.document_id()).start_at([hoje]).stream())
+                ids_no_firestore = {doc.id for doc in docs}
+                with lock:
+                    for doc in docs:
+                        _gravar_no_espelho(conn, unidade_id, doc)
+                    ids_no_espelho = conn.execute(
+                        "SELECT doc_id FROM agendamentos WHERE unidade = ? AND data >= ?",
+                        (unidade_id, hoje),
+                    ).fetchall()
+                    conn.executemany(
+                        "DELETE FROM agendamentos WHERE unidade = ? AND doc_id = ?",
+                        [(unidade_id, doc_id) for (doc_id,) in ids_no_espelho if doc_id not in ids_no_firestore],
+                    )
+                    conn.commit()
+                ultima_reconciliacao = agora
+
+        with lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO sincronizacao (unidade, ultimo_timestamp, ultimo_doc_id, ultima_reconciliacao) VALUES (?, ?, ?, ?)",
+                (unidade_id, ultimo_timestamp, ultimo_doc_id, ultima_reconciliacao),
+            )
+            conn.commit()
+        controle['ultima'][unidade_id] = agora
+    finally:
+        lock_da_unidade.release()
+
+def remover_do_espelho(unidade_id, doc_id):
+    """Apaga do espelho um documento que esta aplicação acabou de excluir no Firestore."""
+    if not ESPELHO_SQLITE:
+        return
+    conn, lock = obter_espelho()
+    with lock:
+        conn.execute("DELETE FROM agendamentos WHERE unidade = ? AND doc_id = ?", (unidade_id, doc_id))
+        conn.commit()
+
+def marcar_arquivados_no_espelho(unidade_id, doc_ids):
+    """Marca como arquivados os documentos que saíram da coleção quente, mantendo-os consultáveis."""
+    if not ESPELHO_SQLITE:
+        return
+    conn, lock = obter_espelho()
+    with lock:
+        conn.executemany(
+            "UPDATE agendamentos SET arquivado = 1 WHERE unidade = ? AND doc_id = ?",
+            [(unidade_id, doc_id) for doc_id in doc_ids],
+        )
+        conn.commit()
+
+def consultar_espelho(unidade_id, data_inicio, data_fim=None, barbeiro=None, telefone=None, incluir_arquivados=False):
+    """
+    Consulta o espelho por período (datas YYYY-MM-DD, inclusivas), podendo
+    filtrar por barbeiro ou telefone, sem leituras no Firestore.
+    Retorna um dicionário {ID do documento: dados}, como a consulta do dia.
+    Documentos já arquivados só entram com incluir_arquivados=True.
+    """
+    sql = "SELECT doc_id, dados FROM agendamentos WHERE unidade = ? AND data BETWEEN ? AND ?"
+    parametros = [unidade_id, data_inicio, data_fim or data_inicio]
+    if not incluir_arquivados:
+        sql += " AND arquivado = 0"
+    if barbeiro:
+        sql += " AND barbeiro = ?"
+        parametros.append(barbeiro)
+    if telefone:
+        sql += " AND telefone = ?"
+        parametros.append(_normalizar_telefone(telefone))
+
+    conn, lock = obter_espelho()
+    with lock:
+        linhas = conn.execute(sql + " ORDER BY doc_id", parametros).fetchall()
+    return {doc_id: _ler_dados_do_espelho(dados) for doc_id, dados in linhas}
+
+# --- ARQUIVAMENTO DOS DIAS PASSADOS ---
+# Agendamentos e bloqueios mais antigos que o horizonte saem da coleção quente
+# e vão para documentos compactos na coleção 'arquivo_agendamentos', um por
+# unidade, mês e barbeiro. A consulta do dia só lê a coleção quente, então nunca
+# enxerga dados arquivados. Desligado por padrão: só roda com a variável de
+# ambiente 'ARQUIVO_HORIZONTE_DIAS' maior que 0 (por exemplo, 30).
+ARQUIVO_COLECAO = 'arquivo_agendamentos'
+ARQUIVO_HORIZONTE_DIAS = int(os.environ.get('ARQUIVO_HORIZONTE_DIAS', '0'))
+# Documentos lidos por lote: cada grupo (mês, barbeiro) cabe num único batch de
+# até 500 operações (1 gravação no arquivo + as exclusões)
+ARQUIVO_TAMANHO_LOTE = 499
+
+def arquivar_dias_passados(unidade_id=UNIDADE_PADRAO_ID, horizonte_dias=ARQUIVO_HORIZONTE_DIAS):
+    """
+    Move para o arquivo os documentos da unidade anteriores a hoje menos o
+    horizonte. Cada grupo (mês, barbeiro) é gravado e apagado no mesmo batch;
+    se o processo cair no meio, rodar de novo é seguro, pois o arquivo é
+    mesclado pela chave do documento. Retorna quantos documentos foram arquivados.
+    """
+    limite = chaves.chave_data(datetime.today() - timedelta(days=max(horizonte_dias, 1)))
+    colecao = colecao_agendamentos(unidade_id)
+    total = 0
+
+    while True:
+        docs = list(colecao.order_by(FieldPath.document_id())
+                           .end_before([limite])
+                           .limit(ARQUIVO_TAMANHO_LOTE)
+                           .stream())
+        if not docs:
+            break
+
+        grupos = {}
+        reservas_vencidas = []
+        for doc in docs:
+            dados = doc.to_dict()
+            _, _, barbeiro_da_chave, tipo = ler_chave_documento(doc.id)
+            if tipo == RESERVA:
+                # Reservas temporárias não têm valor histórico: só são apagadas
+                reservas_vencidas.append(doc.id)
+                continue
+            mes = doc.id[:7]  # YYYY-MM
+            barbeiro = dados.get('barbeiro') or barbeiro_da_chave
+            # Data e barbeiro já estão na chave do documento e no arquivo
+            grupos.setdefault((mes, barbeiro), {})[doc.id] = {
+                campo: valor for campo, valor in dados.items() if campo not in ('data', 'barbeiro', 'timestamp')
+            }
+
+        for (mes, barbeiro), registros in grupos.items():
+            batch = db.batch()
+            batch.set(db.collection(ARQUIVO_COLECAO).document(f"{unidade_id}_{mes}_{barbeiro}"), {
+                'unidade': unidade_id,
+                'mes': mes,
+                'barbeiro': barbeiro,
+                'agendamentos': registros,
+            }, merge=True)
+            for doc_id in registros:
+                batch.delete(colecao.document(doc_id))
+            batch.commit()
+            marcar_arquivados_no_espelho(unidade_id, registros)
+            total += len(registros)
+
+        if reservas_vencidas:
+            batch = db.batch()
+            for doc_id in reservas_vencidas:
+                batch.delete(colecao.document(doc_id))
+            batch.commit()
+
+    return total
+
+def consultar_arquivo(unidade_id, mes, barbeiro=None):
+    """
+    Lê os agendamentos arquivados de um mês (YYYY-MM) da unidade, no mesmo
+    formato da consulta do dia: {ID do documento: dados}.
+    """
+    consulta = db.collection(ARQUIVO_COLECAO) \
+                 .where(filter=FieldFilter('unidade', '==', unidade_id)) \
+                 .where(filter=FieldFilter('mes', '==', mes))
+    if barbeiro:
+        consulta = consulta.where(filter=FieldFilter('barbeiro', '==', barbeiro))
+
+    agendamentos = {}
+    for doc in consulta.stream():
+        arquivo = doc.to_dict()
+        for doc_id, dados in arquivo.get('agendamentos', {}).items():
+            agendamentos[doc_id] = {
+                **dados,
+                'barbeiro': arquivo['barbeiro'],
+                'data': chaves.data_de_chave(doc_id[:10]),
+            }
+    return dict(sorted(agendamentos.items()))
+
+@st.cache_resource(ttl=24 * 60 * 60)
+def iniciar_arquivamento_do_dia(dia):
+    """
+    Dispara em segundo plano, uma vez por dia e por processo, o arquivamento
+    de todas as unidades. O argumento 'dia' só serve de chave do cache.
+    """
+    def executar():
+        for unidade in UNIDADES:
+            try:
+                total = arquivar_dias_passados(unidade["id"])
+                print(f"Arquivamento da unidade {unidade['id']} ({dia}): {total} documento(s) arquivado(s).")
+            except Exception as e:
+                print(f"Erro no arquivamento da unidade {unidade['id']}: {e}")
+
+    threading.Thread(target=executar, daemon=True).start()
+    return True
+
+if ARQUIVO_HORIZONTE_DIAS > 0:
+    iniciar_arquivamento_do_dia(chaves.chave_data(datetime.today()))
 
 # SUBSTITUA A FUNÇÃO INTEIRA PELA VERSÃO ABAIXO:
-def buscar_agendamentos_e_bloqueios_do_dia(data_obj):
+@cronometrar("Firestore")
+def buscar_agendamentos_e_bloqueios_do_dia(data_obj, unidade_id=UNIDADE_PADRAO_ID):
     """
     Busca todos os agendamentos e bloqueios do dia, retornando um dicionário
     com o ID do documento como chave e os dados do documento como valor.
+    Com o espelho SQLite ativo, sincroniza e lê dele em vez do Firestore.
     """
     if not db:
         st.error("Firestore não inicializado.")
         return {}
 
     ocupados_map = {}
-    prefixo_id = data_obj.strftime('%Y-%m-%d')
+    prefixo_id = chaves.chave_data(data_obj)
+
+    if ESPELHO_SQLITE:
+        try:
+            sincronizar_espelho(unidade_id)
+            return consultar_espelho(unidade_id, prefixo_id)
+        except Exception as e:
+            # Se o espelho falhar, a consulta segue direto no Firestore
+            print(f"Espelho SQLite indisponível, lendo do Firestore: {e}")
 
     try:
-        docs = db.collection('agendamentos') \
+        docs = colecao_agendamentos(unidade_id) \
                  .order_by(FieldPath.document_id()) \
                  .start_at([prefixo_id]) \
                  .end_at([prefixo_id + '\uf8ff']) \
@@ -285,29 +941,27 @@ def buscar_agendamentos_e_bloqueios_do_dia(data_obj):
     return ocupados_map
     
 # A SUA FUNÇÃO, COM A CORREÇÃO DO NOME DA VARIÁVEL
-def verificar_disponibilidade_horario_seguinte(data, horario, barbeiro):
+@cronometrar("Firestore")
+def verificar_disponibilidade_horario_seguinte(data, horario, barbeiro, unidade_id=UNIDADE_PADRAO_ID):
     if not db:
         st.error("Firestore não inicializado.")
         return False
 
     try:
-        horario_dt = datetime.strptime(horario, '%H:%M')
-        horario_seguinte_dt = horario_dt + timedelta(minutes=30)
-        if horario_seguinte_dt.hour >= 20:
+        horario_seguinte_str = chaves.horario_seguinte(horario)
+        if horario_seguinte_str is None:
             return False 
 
-        horario_seguinte_str = horario_seguinte_dt.strftime('%H:%M')
-        data_obj = datetime.strptime(data, '%d/%m/%Y')
-        data_para_id = data_obj.strftime('%Y-%m-%d')
+        data_obj = chaves.data_de_texto(data)
 
         # --- A CORREÇÃO ESTÁ AQUI ---
         # O nome da variável foi padronizado para "chave_agendamento_seguinte"
-        chave_agendamento_seguinte = f"{data_para_id}_{horario_seguinte_str}_{barbeiro}"
-        agendamento_ref_seguinte = db.collection('agendamentos').document(chave_agendamento_seguinte)
+        chave_agendamento_seguinte = chave_documento(data_obj, horario_seguinte_str, barbeiro)
+        agendamento_ref_seguinte = colecao_agendamentos(unidade_id).document(chave_agendamento_seguinte)
         # --- FIM DA CORREÇÃO ---
 
-        chave_bloqueio_seguinte = f"{data_para_id}_{horario_seguinte_str}_{barbeiro}_BLOQUEADO"
-        bloqueio_ref_seguinte = db.collection('agendamentos').document(chave_bloqueio_seguinte)
+        chave_bloqueio_seguinte = chave_documento(data_obj, horario_seguinte_str, barbeiro, BLOQUEADO)
+        bloqueio_ref_seguinte = colecao_agendamentos(unidade_id).document(chave_bloqueio_seguinte)
 
         doc_agendamento_seguinte = agendamento_ref_seguinte.get()
         doc_bloqueio_seguinte = bloqueio_ref_seguinte.get()
@@ -321,8 +975,19 @@ def verificar_disponibilidade_horario_seguinte(data, horario, barbeiro):
         st.error(f"Erro inesperado ao verificar disponibilidade do horário seguinte: {e}")
         return False
 
+# Template e fontes são decodificados uma vez por processo e reaproveitados
+# pelo resumo do cliente e pela agenda do dia.
+@st.cache_resource
+def carregar_template_resumo():
+    return Image.open(os.path.join(BASE_DIR, "template_resumo.png")).convert("RGBA") # .convert("RGBA") para melhor compatibilidade com PNG
+
+@st.cache_resource
+def carregar_fonte(tamanho):
+    return ImageFont.truetype(os.path.join(BASE_DIR, "font.ttf"), tamanho)
+
 # NOVA FUNÇÃO PARA GERAR A IMAGEM DE RESUMO
-def gerar_imagem_resumo(nome, data, horario, barbeiro, servicos):
+@cronometrar("Imagem (gerar_imagem_resumo)")
+def gerar_imagem_resumo(nome, data, horario, barbeiro, servicos, unidade=None):
     """
     Gera uma imagem de resumo do agendamento.
 
@@ -332,14 +997,14 @@ def gerar_imagem_resumo(nome, data, horario, barbeiro, servicos):
         horario (str): Horário do agendamento (ex: "10:30").
         barbeiro (str): Nome do barbeiro.
         servicos (list): Lista de serviços selecionados.
+        unidade (str): Nome da unidade onde o cliente será atendido.
 
     Returns:
         bytes: A imagem gerada em formato PNG como bytes, pronta para download.
     """
     try:
-        template_path = "template_resumo.png"  # <-- LINHA CORRIGIDA
-        font_path = "font.ttf"
-        img = Image.open(template_path).convert("RGBA") # Adicionado .convert("RGBA") para melhor compatibilidade com PNG
+        # Cópia do template já decodificado (não altera o que está em cache)
+        img = carregar_template_resumo().copy()
         draw = ImageDraw.Draw(img)
         
         # 1. Defina a largura máxima em pixels que o nome pode ocupar.
@@ -350,23 +1015,24 @@ def gerar_imagem_resumo(nome, data, horario, barbeiro, servicos):
         tamanho_fonte_minimo = 30 
 
         # 3. Carrega a fonte com o tamanho inicial.
-        font_nome = ImageFont.truetype(font_path, tamanho_fonte_nome)
+        font_nome = carregar_fonte(tamanho_fonte_nome)
 
         # 4. Loop para reduzir o tamanho da fonte se o nome for muito largo.
         while font_nome.getbbox(nome)[2] > LARGURA_MAXIMA_NOME and tamanho_fonte_nome > tamanho_fonte_minimo:
             tamanho_fonte_nome -= 5 
-            font_nome = ImageFont.truetype(font_path, tamanho_fonte_nome)
+            font_nome = carregar_fonte(tamanho_fonte_nome)
 
         # Carrega a fonte para o corpo do texto (esta linha continua existindo).
-        font_corpo = ImageFont.truetype(font_path, 65)
+        font_corpo = carregar_fonte(65)
 
         # 2. Formata o texto do resumo
         # Junta a lista de serviços em uma única string, com quebra de linha se for longa
         servicos_str = ", ".join(servicos)
+        linha_unidade = f"Unidade: {unidade}\n" if unidade else ""
         if len(servicos_str) > 30: # Se a linha de serviços for muito longa
             servicos_formatados = '\n'.join(servicos) # Coloca um serviço por linha
             texto_resumo = f"""
-Data: {data}
+{linha_unidade}Data: {data}
 Horário: {horario}
 Barbeiro: {barbeiro}
 Serviços:
@@ -374,7 +1040,7 @@ Serviços:
 """
         else:
             texto_resumo = f"""
-Data: {data}
+{linha_unidade}Data: {data}
 Horário: {horario}
 Barbeiro: {barbeiro}
 Serviços: {servicos_str}
@@ -403,45 +1069,559 @@ Serviços: {servicos_str}
     except Exception as e:
         st.error(f"Ocorreu um erro ao gerar a imagem: {e}")
         return None
+
+# Medidas da folha de agenda do dia, em pixels
+AGENDA_MARGEM = 40
+AGENDA_COLUNA_HORARIO = 110
+AGENDA_COLUNA_BARBEIRO = 380
+AGENDA_ALTURA_CABECALHO = 130
+AGENDA_ALTURA_LINHA = 44
+
+# Poucas agendas recentes em cache: cada mudança no dia gera uma imagem nova
+@st.cache_data(show_spinner=False, max_entries=20, ttl=60 * 60)
+def gerar_agenda_do_dia(titulo, barbeiros, linhas, formato="PNG"):
+    """
+    Desenha a agenda do dia numa única folha, com uma coluna por barbeiro.
+
+    Args:
+        titulo (str): Título da folha (unidade e data).
+        barbeiros (tuple): Barbeiros, na ordem das colunas.
+        linhas (tuple): Uma tupla (horário, textos por barbeiro) por linha.
+        formato (str): "PNG" ou "PDF".
+
+    Returns:
+        bytes: A folha no formato pedido. Como os dados do dia fazem parte dos
+        argumentos, o cache só é refeito quando a agenda muda.
+    """
+    try:
+        font_titulo = carregar_fonte(48)
+        font_cabecalho = carregar_fonte(28)
+        font_celula = carregar_fonte(22)
+
+        largura = 2 * AGENDA_MARGEM + AGENDA_COLUNA_HORARIO + len(barbeiros) * AGENDA_COLUNA_BARBEIRO
+        altura = 2 * AGENDA_MARGEM + AGENDA_ALTURA_CABECALHO + len(linhas) * AGENDA_ALTURA_LINHA
+        img = Image.new("RGB", (largura, altura), "white")
+        draw = ImageDraw.Draw(img)
+        cor_texto = (0, 0, 0)
+        cor_grade = (200, 200, 200)
+
+        draw.text((AGENDA_MARGEM, AGENDA_MARGEM), titulo, fill=cor_texto, font=font_titulo)
+        y = AGENDA_MARGEM + AGENDA_ALTURA_CABECALHO - AGENDA_ALTURA_LINHA
+        for i, barbeiro in enumerate(barbeiros):
+            x = AGENDA_MARGEM + AGENDA_COLUNA_HORARIO + i * AGENDA_COLUNA_BARBEIRO
+            draw.text((x + 10, y + 8), barbeiro, fill=cor_texto, font=font_cabecalho)
+
+        for linha, (horario, textos) in enumerate(linhas):
+            y = AGENDA_MARGEM + AGENDA_ALTURA_CABECALHO + linha * AGENDA_ALTURA_LINHA
+            if linha % 2 == 0:
+                draw.rectangle([AGENDA_MARGEM, y, largura - AGENDA_MARGEM, y + AGENDA_ALTURA_LINHA], fill=(245, 245, 245))
+            draw.line([AGENDA_MARGEM, y, largura - AGENDA_MARGEM, y], fill=cor_grade)
+            draw.text((AGENDA_MARGEM + 10, y + 10), horario, fill=cor_texto, font=font_celula)
+            for i, texto in enumerate(textos):
+                x = AGENDA_MARGEM + AGENDA_COLUNA_HORARIO + i * AGENDA_COLUNA_BARBEIRO
+                # Corta o texto que não cabe na coluna
+                while texto and font_celula.getlength(texto) > AGENDA_COLUNA_BARBEIRO - 20:
+                    texto = texto[:-2] + "…"
+                draw.text((x + 10, y + 10), texto, fill=cor_texto, font=font_celula)
+
+        for i in range(len(barbeiros) + 1):
+            x = AGENDA_MARGEM + AGENDA_COLUNA_HORARIO + i * AGENDA_COLUNA_BARBEIRO
+            draw.line([x, AGENDA_MARGEM + AGENDA_ALTURA_CABECALHO - AGENDA_ALTURA_LINHA, x, altura - AGENDA_MARGEM], fill=cor_grade)
+
+        buf = io.BytesIO()
+        img.save(buf, format=formato)
+        return buf.getvalue()
+
+    except FileNotFoundError:
+        st.error("Erro: Verifique se o arquivo 'font.ttf' está na pasta do projeto.")
+        return None
+    except Exception as e:
+        st.error(f"Ocorreu um erro ao gerar a agenda do dia: {e}")
+        return None
+
+def linhas_da_agenda(horarios, barbeiros, codec, data_obj, ocupados_do_dia, mapa_status_por_horario):
+    """Monta as linhas da agenda a partir da consulta do dia (indexada pelo codec) e do status da tabela."""
+    linhas = []
+    for horario in horarios:
+        textos = []
+        for barbeiro in barbeiros:
+            indice = codec.codificar(data_obj, horario, barbeiro)
+            dados = ocupados_do_dia.get(indice)
+            status = mapa_status_por_horario.get(horario, {}).get(barbeiro)
+            if dados and dados.get('nome') != 'Fechado':
+                textos.append(f"{dados.get('nome', '')} - {', '.join(dados.get('servicos', []))}")
+            elif indice + codec.deslocamento[BLOQUEADO] in ocupados_do_dia:
+                textos.append("(continuação)")
+            elif status in ("Disponível", "Reservado", None):
+                textos.append("")
+            else:
+                textos.append(status)
+        linhas.append((horario, tuple(textos)))
+    return tuple(linhas)
         
 # Função para bloquear horário para um barbeiro específico
-def bloquear_horario(data, horario, barbeiro):
+@cronometrar("Firestore")
+def bloquear_horario(data, horario, barbeiro, unidade_id=UNIDADE_PADRAO_ID):
     if not db:
         st.error("Firestore não inicializado. Não é possível bloquear.")
         return False
 
     # 1. Converte a string de data "dd/mm/yyyy" para um objeto de data.
     try:
-        data_obj = datetime.strptime(data, '%d/%m/%Y')
+        data_obj = datetime.combine(chaves.data_de_texto(data), datetime.min.time())
     except ValueError:
         st.error("Formato de data inválido para bloqueio.")
         return False
 
     # 2. Usa o objeto de data para criar o ID no formato CORRETO (YYYY-MM-DD).
-    data_para_id = data_obj.strftime('%Y-%m-%d')
-    chave_bloqueio = f"{data_para_id}_{horario}_{barbeiro}_BLOQUEADO"
+    chave_bloqueio = chave_documento(data_obj, horario, barbeiro, BLOQUEADO)
 
     try:
         # 3. Usa a chave correta para criar o documento de bloqueio.
-        db.collection('agendamentos').document(chave_bloqueio).set({
+        colecao_agendamentos(unidade_id).document(chave_bloqueio).set({
             'nome': "BLOQUEADO",
             'telefone': "BLOQUEADO",
             'servicos': ["BLOQUEADO"],
             'barbeiro': barbeiro,
             'data': data_obj,  # Salva o objeto de data no documento
             'horario': horario,
-            'agendado_por': 'bloqueio_interno' # Campo para identificar a origem
+            'agendado_por': 'bloqueio_interno', # Campo para identificar a origem
+            'timestamp': firestore.SERVER_TIMESTAMP  # Usado pela sincronização do espelho SQLite
         })
         return True
     except Exception as e:
         st.error(f"Erro ao bloquear horário: {e}")
         return False
 
+# --- IMPORTAÇÃO EM LOTE (CSV/XLSX) ---
+# Agendamentos anotados fora do sistema (telefone, WhatsApp) entram de uma vez
+# pelo modo administrador. Cada linha passa pelas mesmas regras da agenda e
+# gera os mesmos IDs de documento do formulário; as gravações vão em batches
+# de até 500 operações, sem um rerun por registro.
+IMPORTACAO_COLUNAS = ["data", "horario", "nome", "telefone", "servicos", "barbeiro"]
+IMPORTACAO_OPERACOES_POR_LOTE = 500
+SERVICOS_CORTE = ["Tradicional", "Social", "Degradê", "Navalhado"]
+
+def _ler_data_importacao(valor):
+    for formato in ('%d/%m/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(valor.strip(), formato)
+        except ValueError:
+            continue
+    raise ValueError(f"data inválida '{valor}' (use dd/mm/aaaa)")
+
+def _ler_horario_importacao(valor):
+    for formato in ('%H:%M', '%H:%M:%S'):
+        try:
+            return datetime.strptime(valor.strip(), formato).strftime('%H:%M')
+        except ValueError:
+            continue
+    raise ValueError(f"horário inválido '{valor}' (use hh:mm)")
+
+def importar_agendamentos(planilha, unidade_id=UNIDADE_PADRAO_ID):
+    """
+    Valida e grava em lote os agendamentos de uma planilha (DataFrame com as
+    colunas de IMPORTACAO_COLUNAS). Conflitos com documentos existentes, com
+    reservas ativas ou entre linhas da própria planilha não são gravados.
+
+    Returns:
+        pandas.DataFrame: Uma linha por registro, com o resultado e o motivo.
+    """
+    regras = {barbeiro["nome"]: barbeiro for barbeiro in UNIDADES_POR_ID[unidade_id]["barbeiros"]}
+    servicos_visagismo = ["Abordagem de visagismo", "Consultoria de visagismo"]
+    colecao = colecao_agendamentos(unidade_id)
+    codec = CODEC_POR_UNIDADE[unidade_id]
+    existentes_por_dia = {}
+    ocupados_na_planilha = set()  # Índices do codec já usados por linhas anteriores
+    relatorio = []
+    operacoes_por_linha = []  # (número da linha, [(doc_id, dados), ...])
+
+    for indice, registro in planilha.fillna("").astype(str).iterrows():
+        linha = indice + 2  # Linha 1 é o cabeçalho
+        try:
+            data_obj = _ler_data_importacao(registro["data"])
+            horario = _ler_horario_importacao(registro["horario"])
+            nome = registro["nome"].strip()
+            telefone = registro["telefone"].strip()
+            barbeiro = registro["barbeiro"].strip()
+            servicos_linha = [servico.strip() for servico in registro["servicos"].split(",") if servico.strip()]
+
+            if not nome or not telefone or not servicos_linha:
+                raise ValueError("nome, telefone e serviços são obrigatórios")
+            if barbeiro not in regras:
+                raise ValueError(f"barbeiro '{barbeiro}' não atende nesta unidade")
+            if horario not in chaves.INDICE_HORARIO:
+                raise ValueError(f"horário {horario} fora da grade de atendimento")
+            servicos_invalidos = [servico for servico in servicos_linha if servico not in servicos]
+            if servicos_invalidos:
+                raise ValueError(f"serviço(s) desconhecido(s): {', '.join(servicos_invalidos)}")
+            if any(servico in servicos_visagismo for servico in servicos_linha) and not regras[barbeiro]["visagismo"]:
+                raise ValueError(f"{barbeiro} não realiza visagismo")
+            motivo = motivo_indisponibilidade(regras[barbeiro], data_obj, horario)
+            if motivo:
+                raise ValueError(f"horário indisponível para {barbeiro} ({motivo})")
+        except (ValueError, KeyError) as e:
+            relatorio.append({"linha": linha, "resultado": "Erro", "motivo": str(e)})
+            continue
+
+        # Uma única consulta por dia presente na planilha
+        data_para_id = chaves.chave_data(data_obj)
+        if data_para_id not in existentes_por_dia:
+            existentes_por_dia[data_para_id] = codec.indexar(buscar_agendamentos_e_bloqueios_do_dia(data_obj, unidade_id))
+        existentes = existentes_por_dia[data_para_id]
+
+        def horario_ocupado(indice_verificado):
+            return (
+                indice_verificado in existentes
+                or indice_verificado + codec.deslocamento[BLOQUEADO] in existentes
+                or reserva_ativa(existentes.get(indice_verificado + codec.deslocamento[RESERVA]))
+                or indice_verificado in ocupados_na_planilha
+            )
+
+        indice_agendamento = codec.codificar(data_obj, horario, barbeiro)
+        chave_agendamento = chave_documento(data_para_id, horario, barbeiro)
+        if horario_ocupado(indice_agendamento):
+            relatorio.append({"linha": linha, "resultado": "Conflito", "motivo": f"{horario} já ocupado para {barbeiro}"})
+            continue
+
+        operacoes = [(chave_agendamento, {
+            'data': data_obj,
+            'horario': horario,
+            'nome': nome,
+            'telefone': telefone,
+            'servicos': servicos_linha,
+            'barbeiro': barbeiro,
+            'agendado_por': 'importacao',
+            'timestamp': firestore.SERVER_TIMESTAMP
+        })]
+
+        # Corte + barba ocupa também o horário seguinte, como no formulário
+        if any(corte in servicos_linha for corte in SERVICOS_CORTE) and "Barba" in servicos_linha:
+            indice_seguinte = codec.seguinte(indice_agendamento)
+            horario_seguinte_str = chaves.horario_seguinte(horario) or "20:00"
+            if indice_seguinte is None or horario_ocupado(indice_seguinte):
+                relatorio.append({"linha": linha, "resultado": "Conflito", "motivo": f"corte e barba, mas {horario_seguinte_str} não está livre"})
+                continue
+            chave_bloqueio = chave_documento(data_para_id, horario_seguinte_str, barbeiro, BLOQUEADO)
+            operacoes.append((chave_bloqueio, {
+                'nome': "BLOQUEADO",
+                'telefone': "BLOQUEADO",
+                'servicos': ["BLOQUEADO"],
+                'barbeiro': barbeiro,
+                'data': data_obj,
+                'horario': horario_seguinte_str,
+                'agendado_por': 'bloqueio_interno',
+                'timestamp': firestore.SERVER_TIMESTAMP
+            }))
+            ocupados_na_planilha.add(indice_seguinte)
+
+        ocupados_na_planilha.add(indice_agendamento)
+        operacoes_por_linha.append((linha, operacoes))
+
+    def gravar(linhas_e_operacoes):
+        batch = db.batch()
+        for _, operacoes in linhas_e_operacoes:
+            for doc_id, dados in operacoes:
+                batch.create(colecao.document(doc_id), dados)
+        batch.commit()
+
+    # Gravação em batches de até 500 operações, sem separar o agendamento do seu bloqueio.
+    # create() falha se o documento surgiu depois da verificação, e o batch inteiro é
+    # recusado; nesse caso o lote é regravado linha a linha para isolar o conflito.
+    lote, operacoes_no_lote = [], 0
+    for indice, (linha, operacoes) in enumerate(operacoes_por_linha):
+        lote.append((linha, operacoes))
+        operacoes_no_lote += len(operacoes)
+        proximas = operacoes_por_linha[indice + 1][1] if indice + 1 < len(operacoes_por_linha) else []
+        if proximas and operacoes_no_lote + len(proximas) <= IMPORTACAO_OPERACOES_POR_LOTE:
+            continue
+
+        try:
+            gravar(lote)
+            relatorio.extend({"linha": l, "resultado": "Importado", "motivo": ""} for l, _ in lote)
+        except google.api_core.exceptions.AlreadyExists:
+            for linha_do_lote in lote:
+                try:
+                    gravar([linha_do_lote])
+                    relatorio.append({"linha": linha_do_lote[0], "resultado": "Importado", "motivo": ""})
+                except google.api_core.exceptions.AlreadyExists as e:
+                    relatorio.append({"linha": linha_do_lote[0], "resultado": "Conflito", "motivo": f"documento criado durante a importação: {e}"})
+                except Exception as e:
+                    relatorio.append({"linha": linha_do_lote[0], "resultado": "Erro", "motivo": f"falha ao gravar a linha: {e}"})
+        except Exception as e:
+            relatorio.extend({"linha": l, "resultado": "Erro", "motivo": f"falha ao gravar o lote: {e}"} for l, _ in lote)
+        lote, operacoes_no_lote = [], 0
+
+    return pd.DataFrame(relatorio, columns=["linha", "resultado", "motivo"]).sort_values("linha")
+
+# --- RESERVAS TEMPORÁRIAS DE HORÁRIO ---
+# Ao escolher um horário, o cliente segura a vaga por RESERVA_TTL_MINUTOS
+# (0 desliga) com um documento '<chave>_RESERVA' na coleção da unidade. As
+# outras sessões veem o horário como "Reservado" até a reserva expirar ou virar
+# agendamento em salvar_agendamento. Reservas vencidas são ignoradas na leitura;
+# a política de TTL do Firestore no campo 'expira_em' apaga os documentos.
+RESERVA_TTL_MINUTOS = int(os.environ.get('RESERVA_TTL_MINUTOS', '5'))
+
+def reserva_ativa(dados_reserva, id_sessao=None):
+    """True se a reserva existe, não expirou e pertence a outra sessão."""
+    if not dados_reserva or dados_reserva.get('sessao') == id_sessao:
+        return False
+    expira_em = dados_reserva.get('expira_em')
+    return expira_em is not None and expira_em > datetime.now(timezone.utc)
+
+@cronometrar("Firestore")
+def reservar_horario(unidade_id, data_para_id, horario, barbeiro, id_sessao):
+    """
+    Cria (ou renova) a reserva temporária do horário para a sessão.
+    Retorna False se outra sessão tiver uma reserva ativa no mesmo horário
+    e None se não foi possível reservar por erro no Firestore.
+    """
+    reserva_ref = colecao_agendamentos(unidade_id).document(chave_documento(data_para_id, horario, barbeiro, RESERVA))
+
+    @firestore.transactional
+    def reservar_em_transacao(transaction):
+        reserva = reserva_ref.get(transaction=transaction)
+        if reserva.exists and reserva_ativa(reserva.to_dict(), id_sessao):
+            return False
+        transaction.set(reserva_ref, {
+            'nome': 'RESERVA',
+            'barbeiro': barbeiro,
+            'data': chaves.data_de_chave(data_para_id),
+            'horario': horario,
+            'sessao': id_sessao,
+            'expira_em': datetime.now(timezone.utc) + timedelta(minutes=RESERVA_TTL_MINUTOS),
+            'timestamp': firestore.SERVER_TIMESTAMP
+        })
+        return True
+
+    try:
+        return reservar_em_transacao(db.transaction())
+    except Exception as e:
+        # Sem reserva o agendamento continua possível; a transação final decide
+        print(f"Erro ao reservar horário: {e}")
+        return None
+
+@cronometrar("Firestore")
+def liberar_reserva(unidade_id, data_para_id, horario, barbeiro, id_sessao):
+    """
+    Apaga a reserva temporária que a sessão deixou de usar. Se a reserva
+    venceu e outra sessão já reservou o horário, a reserva dela fica.
+    """
+    chave_reserva = chave_documento(data_para_id, horario, barbeiro, RESERVA)
+    reserva_ref = colecao_agendamentos(unidade_id).document(chave_reserva)
+
+    @firestore.transactional
+    def liberar_em_transacao(transaction):
+        reserva = reserva_ref.get(transaction=transaction)
+        if not reserva.exists or reserva.to_dict().get('sessao') != id_sessao:
+            return False
+        transaction.delete(reserva_ref)
+        return True
+
+    try:
+        if liberar_em_transacao(db.transaction()):
+            remover_do_espelho(unidade_id, chave_reserva)
+    except Exception as e:
+        print(f"Erro ao liberar reserva: {e}")
+
+# --- ADMISSÃO POR HORÁRIO ---
+# Camada em memória, compartilhada pelas sessões do processo, que deixa só uma
+# submissão por vez gravar cada (unidade, data, horário, barbeiro). Em picos
+# (intervalo especial de julho, feriados) quem chega depois é recusado na hora,
+# sem esperar a transação do Firestore falhar.
+ADMISSAO_TTL_PROCESSAMENTO_SEG = 60  # Libera a vaga se a sessão morrer no meio da gravação
+ADMISSAO_TTL_CONFIRMADO_SEG = 120    # Recusa novas tentativas até a tabela refletir o agendamento
+
+@st.cache_resource
+def obter_fila_de_horarios():
+    """Estado da admissão, único por processo."""
+    return {
+        "lock": threading.Lock(),
+        "em_processamento": {},  # chave -> instante em que expira
+        "admitido_em": {},       # chave -> perf_counter() da admissão
+        "confirmados": {},       # chave -> instante em que expira
+        "metricas": {"admitidos": 0, "recusados": 0, "liberados": 0, "ocupacao_total": 0.0, "ocupacao_maxima": 0.0},
+    }
+
+def admitir_horario(chave_horario):
+    """
+    Tenta pegar a vez de gravar o horário. Retorna False na hora se outra
+    sessão já estiver gravando ou tiver acabado de confirmar o mesmo horário.
+    Quem for admitido deve chamar liberar_horario() ao terminar.
+    """
+    fila = obter_fila_de_horarios()
+    with fila["lock"]:
+        agora = time.time()
+        for registro in (fila["em_processamento"], fila["confirmados"]):
+            for chave, expira_em in list(registro.items()):
+                if expira_em < agora:
+                    del registro[chave]
+                    fila["admitido_em"].pop(chave, None)
+
+        metricas = fila["metricas"]
+        if chave_horario in fila["em_processamento"] or chave_horario in fila["confirmados"]:
+            metricas["recusados"] += 1
+            print(f"Admissão recusada para {chave_horario}. {resumo_metricas_fila()}")
+            return False
+
+        metricas["admitidos"] += 1
+        fila["em_processamento"][chave_horario] = agora + ADMISSAO_TTL_PROCESSAMENTO_SEG
+        fila["admitido_em"][chave_horario] = time.perf_counter()
+        return True
+
+def liberar_horario(chave_horario, confirmado=False):
+    """Devolve a vez do horário; se confirmado, segura novas tentativas por um tempo."""
+    fila = obter_fila_de_horarios()
+    with fila["lock"]:
+        fila["em_processamento"].pop(chave_horario, None)
+        admitido_em = fila["admitido_em"].pop(chave_horario, None)
+        if admitido_em is not None:
+            # Quanto tempo a vaga ficou ocupada, da admissão até a liberação
+            ocupacao = time.perf_counter() - admitido_em
+            metricas = fila["metricas"]
+            metricas["liberados"] += 1
+            metricas["ocupacao_total"] += ocupacao
+            metricas["ocupacao_maxima"] = max(metricas["ocupacao_maxima"], ocupacao)
+        if confirmado:
+            fila["confirmados"][chave_horario] = time.time() + ADMISSAO_TTL_CONFIRMADO_SEG
+        else:
+            fila["confirmados"].pop(chave_horario, None)
+
+def resumo_metricas_fila():
+    """Texto com admissões, recusas e tempo médio/máximo que cada vaga ficou ocupada."""
+    metricas = obter_fila_de_horarios()["metricas"]
+    ocupacao_media = (metricas["ocupacao_total"] / metricas["liberados"]) if metricas["liberados"] else 0.0
+    return (
+        f"Admitidos: {metricas['admitidos']} | Recusados: {metricas['recusados']} | "
+        f"Vaga ocupada, média: {ocupacao_media:.2f} s | máxima: {metricas['ocupacao_maxima']:.2f} s"
+    )
+
+def horarios_alternativos(horario, horarios_disponiveis, quantidade=3):
+    """Os horários disponíveis mais próximos do pedido, do mais perto para o mais longe."""
+    minutos = chaves.MINUTOS_DO_HORARIO
+    alvo = minutos[horario]
+    candidatos = [h for h in horarios_disponiveis if h != horario]
+    return sorted(candidatos, key=lambda h: abs(minutos[h] - alvo))[:quantidade]
+
+# --- SUBMISSÕES IDEMPOTENTES ---
+# Cada renderização do formulário ganha uma chave (st.session_state) que,
+# junto com os dados enviados, identifica a submissão. Cada efeito colateral
+# (transação, bloqueio, e-mail, imagem) fica registrado por chave assim que
+# termina; um segundo toque em "Confirmar Agendamento" reaproveita o que já foi
+# feito em vez de repetir a transação, o envio SMTP e a geração da imagem.
+# O toque repetido sempre cai na mesma sessão, então o registro fica no
+# st.session_state e é descartado quando o formulário ganha uma chave nova.
+
+def obter_registro_de_submissoes():
+    """Etapas concluídas por chave de submissão, guardadas na sessão."""
+    return st.session_state.setdefault('submissoes', {})
+
+def gerar_chave_idempotencia(chave_formulario, *dados):
+    """Combina a chave do formulário com um hash dos dados enviados."""
+    resumo_dados = hashlib.sha256(json.dumps(dados, default=str, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{chave_formulario}:{resumo_dados}"
+
+def etapa_concluida(chave_idempotencia, etapa):
+    """Resultado de uma etapa já concluída para a submissão, ou None."""
+    return obter_registro_de_submissoes().get(chave_idempotencia, {}).get(etapa)
+
+def registrar_etapa(chave_idempotencia, etapa, resultado):
+    obter_registro_de_submissoes().setdefault(chave_idempotencia, {})[etapa] = resultado
+
+def executar_uma_vez(chave_idempotencia, etapa, funcao, *args, **kwargs):
+    """
+    Executa a etapa só se ela ainda não foi concluída para esta submissão.
+    Resultados vazios (falhas) não são registrados, para poderem ser refeitos.
+    """
+    resultado = etapa_concluida(chave_idempotencia, etapa)
+    if resultado is not None:
+        return resultado
+    resultado = funcao(*args, **kwargs)
+    if resultado:
+        registrar_etapa(chave_idempotencia, etapa, resultado)
+    return resultado
+
+def concluir_agendamento(chave_idempotencia, agendamento):
+    """
+    Etapas que vêm depois da transação (bloqueio do horário seguinte, e-mail,
+    mensagens e imagem de resumo). Numa submissão repetida só refaz o que
+    ainda não tinha terminado.
+    """
+    horario_seguinte_bloqueado = False
+    if agendamento['precisa_bloquear_proximo']:
+        horario_seguinte_str = chaves.horario_seguinte(agendamento['horario'])
+        horario_seguinte_bloqueado = executar_uma_vez(
+            chave_idempotencia, "bloqueio", bloquear_horario,
+            agendamento['data'], horario_seguinte_str, agendamento['barbeiro'], agendamento['unidade_id'],
+        )
+        if not horario_seguinte_bloqueado:
+             st.warning("O agendamento principal foi salvo, mas houve um erro ao bloquear o horário seguinte. Por favor, entre em contato com a barbearia se necessário.")
+
+    # --- Preparar e Enviar E-mail ---
+    nome_unidade = UNIDADES_POR_ID[agendamento['unidade_id']]['nome']
+    resumo = f"""
+    Unidade: {nome_unidade}
+    Nome: {agendamento['nome']}
+    Telefone: {agendamento['telefone']}
+    Data: {agendamento['data']}
+    Horário: {agendamento['horario']}
+    Barbeiro: {agendamento['barbeiro']}
+    Serviços: {', '.join(agendamento['servicos'])}
+    """
+    executar_uma_vez(chave_idempotencia, "email", enviar_email, f"Agendamento Confirmado - {nome_unidade}", resumo)
+
+    # --- Mensagem de Sucesso ---
+    st.success("Agendamento confirmado com sucesso!")
+    st.info("Resumo do agendamento:\n" + resumo)
+    if horario_seguinte_bloqueado:
+        st.info(f"O horário das {horario_seguinte_str} com {agendamento['barbeiro']} foi bloqueado para acomodar todos os serviços.")
+
+    # Chama a função para gerar a imagem com os dados do agendamento
+    imagem_bytes = executar_uma_vez(
+        chave_idempotencia, "imagem", gerar_imagem_resumo,
+        nome=agendamento['nome'],
+        data=agendamento['data'],
+        horario=agendamento['horario'],
+        barbeiro=agendamento['barbeiro'],
+        servicos=agendamento['servicos'],
+        unidade=nome_unidade,
+    )
+
+    # Se a imagem foi gerada corretamente, mostra o botão de download
+    if imagem_bytes:
+        st.download_button(
+            label="📥 Baixar Resumo do Agendamento",
+            data=imagem_bytes,
+            file_name=f"agendamento_{agendamento['nome'].split(' ')[0]}_{agendamento['data'].replace('/', '-')}.png",
+            mime="image/png"
+        )
+
 # Interface Streamlit
-st.title("Barbearia Lucas Borges - Agendamentos")
+# O título mostra a unidade escolhida, que só é conhecida depois do seletor abaixo
+titulo_pagina = st.empty()
 st.header("Faça seu agendamento ou cancele")
 st.image("https://github.com/barbearialb/sistemalb/blob/main/icone.png?raw=true", use_container_width=True)
 
+# Seleção da unidade (só aparece quando há mais de uma configurada)
+if len(UNIDADES) > 1:
+    unidade_id_atual = st.selectbox(
+        "Unidade",
+        [unidade["id"] for unidade in UNIDADES],
+        format_func=lambda unidade_id: UNIDADES_POR_ID[unidade_id]["nome"],
+        key="unidade_selecionada",
+    )
+else:
+    unidade_id_atual = UNIDADE_PADRAO_ID
+
+unidade_atual = UNIDADES_POR_ID[unidade_id_atual]
+titulo_pagina.title(f"{unidade_atual['nome']} - Agendamentos")
+regras_barbeiros = {barbeiro["nome"]: barbeiro for barbeiro in unidade_atual["barbeiros"]}
+barbeiros = list(regras_barbeiros)
+
+# Identifica a sessão nas reservas temporárias de horário
+if 'id_sessao' not in st.session_state:
+    st.session_state.id_sessao = uuid.uuid4().hex
+
 # Gerenciamento da Data Selecionada no Session State
 if 'data_agendamento' not in st.session_state:
     st.session_state.data_agendamento = datetime.today().date()  # Inicializar como objeto date
@@ -479,11 +1659,15 @@ st.subheader("Disponibilidade dos Barbeiros")
 
 # 1. CHAMA A FUNÇÃO RÁPIDA UMA ÚNICA VEZ
 # Usamos o objeto de data que você já tem
-agendamentos_do_dia = buscar_agendamentos_e_bloqueios_do_dia(data_obj_tabela)
+agendamentos_do_dia = buscar_agendamentos_e_bloqueios_do_dia(data_obj_tabela, unidade_id_atual)
+inicio_tabela = time.perf_counter()
+# Cada chave é lida uma única vez; a tabela e o formulário consultam por índice inteiro
+codec_unidade = CODEC_POR_UNIDADE[unidade_id_atual]
+ocupados_do_dia = codec_unidade.indexar(agendamentos_do_dia)
 
 # 2. CRIA A VARIÁVEL COM O FORMATO CORRETO PARA O ID
 # Esta é a adição importante. Usamos o objeto de data para criar a string YYYY-MM-DD
-data_para_id_tabela = data_obj_tabela.strftime('%Y-%m-%d')
+data_para_id_tabela = chaves.chave_data(data_obj_tabela)
 
 # --- O resto da sua lógica de construção da tabela continua, mas usando a variável correta ---
 html_table = '<table style="font-size: 14px; border-collapse: collapse; width: 100%; border: 1px solid #ddd;"><tr><th style="padding: 8px; border: 1px solid #ddd; background-color: #0e1117; color: white;">Horário</th>'
@@ -491,107 +1675,133 @@ for barbeiro in barbeiros:
     html_table += f'<th style="padding: 8px; border: 1px solid #ddd; background-color: #0e1117; color: white; min-width: 120px; text-align: center;">{barbeiro}</th>'
 html_table += '</tr>'
 
-dia_da_semana_tabela = data_obj_tabela.weekday()
-horarios_tabela = [f"{h:02d}:{m:02d}" for h in range(8, 20) for m in (0, 30)]
-dia_tabela = data_obj_tabela.day
-mes_tabela = data_obj_tabela.month
-intervalo_especial = mes_tabela == 7 and 10 <= dia_tabela <= 19
+horarios_tabela = chaves.HORARIOS_GRADE
 mapa_status_por_horario = {}
 
 for horario in horarios_tabela:
     mapa_status_por_horario.setdefault(horario, {})
     html_table += f'<tr><td style="padding: 8px; border: 1px solid #ddd; text-align: center;">{horario}</td>'
     for barbeiro in barbeiros:
-        # A nova regra: SÓ bloqueia as 8:00 se NÃO for o intervalo especial
-        if dia_da_semana_tabela < 5 and not intervalo_especial and horario == "08:00" and barbeiro == "Lucas Borges":
-            status = "Indisponível"
-            bg_color = "#808080"
-            color_text = "white"
-            html_table += f'<td style="padding: 8px; border: 1px solid #ddd; background-color: {bg_color}; text-align: center; color: {color_text}; height: 30px;">{status}</td>'
-            continue
-            
-        status = "Indisponível"
-        bg_color = "grey"
-        color_text = "white"
-        hora_int = int(horario.split(':')[0])
-
-        # A sua lógica de SDJ (mantida igual)
-        if horario in ["07:00", "07:30"]:
-            dia_do_mes = data_obj_tabela.day
-            mes_do_ano = data_obj_tabela.month
-            if not intervalo_especial:
-                status = "SDJ"
-                bg_color = "#696969"
-                html_table += f'<td style="padding: 8px; border: 1px solid #ddd; background-color: {bg_color}; text-align: center; color: {color_text}; height: 30px;">{status}</td>'
-                continue
-
         # 3. A CORREÇÃO CRUCIAL
-        # Usamos a nova variável `data_para_id_tabela` para criar a chave
-        chave_agendamento = f"{data_para_id_tabela}_{horario}_{barbeiro}"
-        chave_bloqueio = f"{chave_agendamento}_BLOQUEADO"
-
-        disponivel = (chave_agendamento not in agendamentos_do_dia) and (chave_bloqueio not in agendamentos_do_dia)
-
-        # A sua lógica de dias da semana (mantida igual)
-        if dia_da_semana_tabela < 5:
-            almoco_lucas = not intervalo_especial and (hora_int == 12 or hora_int == 13)
-            almoco_aluizio = not intervalo_especial and (hora_int == 12 or hora_int == 13)
-
-            # ===== AQUI ESTÁ A MUDANÇA =====
-            # Verificamos o almoço primeiro
-            if (barbeiro == "Lucas Borges" and almoco_lucas) or (barbeiro == "Aluizio" and almoco_aluizio):
-                # Agora, verificamos se esse horário de almoço foi fechado manualmente
-                dados_agendamento = agendamentos_do_dia.get(chave_agendamento)
-                if dados_agendamento and dados_agendamento.get('nome') == 'Fechado':
-                    status, bg_color, color_text = "Fechado", "#A9A9A9", "black"
-                else:
-                    # Se não foi fechado, continua como Almoço
-                    status, bg_color, color_text = "Almoço", "orange", "black"
-            else:
-                dados_agendamento = agendamentos_do_dia.get(chave_agendamento)
-                if dados_agendamento and dados_agendamento.get('nome') == 'Fechado':
-                    status = "Fechado"
-                    bg_color = "#A9A9A9"
-                    color_text = "black"
-                elif disponivel:
-                    status = "Disponível"
-                    bg_color = "forestgreen"
-                else:
-                    status = "Ocupado"
-                    bg_color = "firebrick"
-
-        elif dia_da_semana_tabela == 5:
-            dados_agendamento = agendamentos_do_dia.get(chave_agendamento)
-            if dados_agendamento and dados_agendamento.get('nome') == 'Fechado':
-                status = "Fechado"
-                bg_color = "#A9A9A9"
-                color_text = "black"
-            elif disponivel:
-                status = "Disponível"
-                bg_color = "forestgreen"
-            else:
-                status = "Ocupado"
-                bg_color = "firebrick"
-
-        elif dia_da_semana_tabela == 6:
-            if intervalo_especial: # Se for o domingo do intervalo especial
-                dados_agendamento = agendamentos_do_dia.get(chave_agendamento)
-                if dados_agendamento and dados_agendamento.get('nome') == 'Fechado':
-                    status, bg_color, color_text = "Fechado", "#A9A9A9", "black"
-                elif disponivel:
-                    status, bg_color = "Disponível", "forestgreen"
-                else:
-                    status, bg_color = "Ocupado", "firebrick"
-            else: # Domingo normal
-                status, bg_color, color_text = "Fechado", "#A9A9A9", "black"
-
-        
+        # O índice do codec substitui a chave; bloqueio e reserva ficam a um deslocamento fixo
+        indice_agendamento = codec_unidade.codificar(data_obj_tabela, horario, barbeiro)
+        dados_agendamento = ocupados_do_dia.get(indice_agendamento)
+
+        # Regras fixas da agenda (SDJ, domingo, horários que o barbeiro não atende e almoço)
+        status = motivo_indisponibilidade(regras_barbeiros[barbeiro], data_obj_tabela, horario)
+
+        if status in (None, "Almoço") and dados_agendamento and dados_agendamento.get('nome') == 'Fechado':
+            # Horário fechado manualmente (inclusive no almoço)
+            status = "Fechado"
+        elif status is None:
+            disponivel = (indice_agendamento not in ocupados_do_dia) and (indice_agendamento + codec_unidade.deslocamento[BLOQUEADO] not in ocupados_do_dia)
+            status = "Disponível" if disponivel else "Ocupado"
+            # Reserva temporária de outra sessão (a da própria sessão continua disponível para ela)
+            if status == "Disponível" and reserva_ativa(ocupados_do_dia.get(indice_agendamento + codec_unidade.deslocamento[RESERVA]), st.session_state.id_sessao):
+                status = "Reservado"
+
+        mapa_status_por_horario[horario][barbeiro] = status
+        bg_color, color_text = CORES_STATUS[status]
         html_table += f'<td style="padding: 8px; border: 1px solid #ddd; background-color: {bg_color}; text-align: center; color: {color_text}; height: 30px;">{status}</td>'
     
     html_table += '</tr>'
 
 html_table += '</table>'
 st.markdown(html_table, unsafe_allow_html=True)
+registrar_tempo("Montagem da tabela", time.perf_counter() - inicio_tabela)
+
+# Agenda do dia para os barbeiros (modo administrador), a partir da mesma consulta da tabela
+if modo_admin:
+    with st.expander("Agenda do dia (barbeiros)"):
+        formato_agenda = st.radio("Formato", ["PNG", "PDF"], horizontal=True)
+        agenda_bytes = gerar_agenda_do_dia(
+            f"{unidade_atual['nome']} - {data_para_tabela}",
+            tuple(barbeiros),
+            linhas_da_agenda(horarios_tabela, barbeiros, codec_unidade, data_obj_tabela, ocupados_do_dia, mapa_status_por_horario),
+            formato_agenda,
+        )
+        if agenda_bytes:
+            if formato_agenda == "PNG":
+                st.image(agenda_bytes)
+            st.download_button(
+                label="📥 Baixar Agenda do Dia",
+                data=agenda_bytes,
+                file_name=f"agenda_{data_para_id_tabela}.{formato_agenda.lower()}",
+                mime="image/png" if formato_agenda == "PNG" else "application/pdf"
+            )
+
+# Escolha do barbeiro fora do formulário para que a lista de horários acompanhe a seleção
+barbeiro_selecionado = st.selectbox("Barbeiro", ["Sem preferência"] + barbeiros)
+
+data_agendamento_str_form = st.session_state.data_agendamento.strftime('%d/%m/%Y') # String para salvar
+data_obj_agendamento_form = st.session_state.data_agendamento # Objeto date para validações
+data_para_id_form = chaves.chave_data(data_obj_agendamento_form) # Prefixo YYYY-MM-DD das chaves
+
+# Geração da lista de horários completa para agendamento
+horarios_base = chaves.HORARIOS_GRADE
+horarios_para_exibir = horarios_base
+
+if data_obj_agendamento_form == datetime.today().date():
+    # Pega apenas a HORA CHEIA atual (ex: 9 para 09:01, 10 para 10:30)
+    hora_atual = datetime.now().hour
+    # Mantém apenas os horários cuja HORA seja MAIOR OU IGUAL à hora atual
+    horarios_para_exibir = [
+        h for h in horarios_para_exibir 
+        if chaves.HORA_DO_HORARIO[h] >= hora_atual
+    ]
+
+# CAMADA 2 E 3: Filtro por Barbeiro e Disponibilidade (usando o mapa_status_por_horario)
+horarios_finais_disponiveis = []
+if barbeiro_selecionado == "Sem preferência":
+    # Mostra o horário se PELO MENOS UM barbeiro estiver disponível
+    for horario in horarios_para_exibir:
+        if any(status == "Disponível" for status in mapa_status_por_horario.get(horario, {}).values()):
+            horarios_finais_disponiveis.append(horario)
+else:
+    # Mostra o horário apenas se O BARBEIRO ESCOLHIDO estiver disponível
+    for horario in horarios_para_exibir:
+        if mapa_status_por_horario.get(horario, {}).get(barbeiro_selecionado) == "Disponível":
+            horarios_finais_disponiveis.append(horario)
+
+# 3. Exibição final do seletor de horário, agora com a lista filtrada.
+# Fica fora do formulário para que a escolha já reserve o horário por alguns minutos.
+if not horarios_finais_disponiveis:
+    st.warning(f"Não há horários disponíveis para '{barbeiro_selecionado}' nesta data.")
+    horario_agendamento = None # Garante que o form não quebre se a lista estiver vazia
+else:
+    # Sem horário pré-selecionado: só reserva quando o cliente escolhe um
+    horario_agendamento = st.selectbox("Horário", horarios_finais_disponiveis, index=None, placeholder="Escolha um horário")
+
+if RESERVA_TTL_MINUTOS and horario_agendamento:
+    reserva_atual = st.session_state.get('reserva_atual')
+    if barbeiro_selecionado != "Sem preferência":
+        barbeiro_da_reserva = barbeiro_selecionado
+    else:
+        livres = [b for b, status in mapa_status_por_horario[horario_agendamento].items() if status == "Disponível"]
+        alvo_anterior = reserva_atual['alvo'] if reserva_atual else None
+        if alvo_anterior and alvo_anterior[:3] == (unidade_id_atual, data_para_id_form, horario_agendamento) and alvo_anterior[3] in livres:
+            # Mantém o barbeiro já reservado para este horário
+            barbeiro_da_reserva = alvo_anterior[3]
+        else:
+            # Reserva com o barbeiro livre menos ocupado, o mesmo que o "Sem preferência" escolheria
+            barbeiro_da_reserva = ordenar_barbeiros_por_carga(livres, agendamentos_do_dia)[0]
+    alvo_da_reserva = (unidade_id_atual, data_para_id_form, horario_agendamento, barbeiro_da_reserva)
+    if st.session_state.get('reserva_recusada') == alvo_da_reserva:
+        # Já recusado nesta sessão: não repete a transação a cada interação com a página
+        st.warning("Este horário acabou de ser reservado por outro cliente. Por favor, escolha outro.")
+    elif not reserva_atual or reserva_atual['alvo'] != alvo_da_reserva:
+        if reserva_atual:
+            liberar_reserva(*reserva_atual['alvo'], st.session_state.id_sessao)
+            st.session_state.reserva_atual = None
+        resultado_reserva = reservar_horario(*alvo_da_reserva, st.session_state.id_sessao)
+        if resultado_reserva:
+            st.session_state.reserva_atual = {'alvo': alvo_da_reserva}
+            st.session_state.reserva_recusada = None
+            st.caption(f"Horário reservado para você por {RESERVA_TTL_MINUTOS} minutos.")
+        elif resultado_reserva is False:
+            st.session_state.reserva_recusada = alvo_da_reserva
+            st.warning("Este horário acabou de ser reservado por outro cliente. Por favor, escolha outro.")
+        # None: erro ao reservar; sem aviso, a transação do agendamento decide
 
 # Aba de Agendamento (FORMULÁRIO)
 with st.form("agendar_form"):
@@ -602,42 +1812,7 @@ with st.form("agendar_form"):
     # Usar o valor do session state para a data DENTRO do formulário
     # A data exibida aqui será a mesma da tabela, pois ambas usam session_state
     st.write(f"Data selecionada: **{st.session_state.data_agendamento.strftime('%d/%m/%Y')}**")
-    data_agendamento_str_form = st.session_state.data_agendamento.strftime('%d/%m/%Y') # String para salvar
-    data_obj_agendamento_form = st.session_state.data_agendamento # Objeto date para validações
-
-    # Geração da lista de horários completa para agendamento
-    horarios_base = [f"{h:02d}:{m:02d}" for h in range(8, 20) for m in (0, 30)]
-    horarios_para_exibir = horarios_base
-    
-    if data_obj_agendamento_form == datetime.today().date():
-        # Pega apenas a HORA CHEIA atual (ex: 9 para 09:01, 10 para 10:30)
-        hora_atual = datetime.now().hour
-        # Mantém apenas os horários cuja HORA seja MAIOR OU IGUAL à hora atual
-        horarios_para_exibir = [
-            h for h in horarios_para_exibir 
-            if int(h.split(':')[0]) >= hora_atual
-        ]
-
-    # CAMADA 2 E 3: Filtro por Barbeiro e Disponibilidade (usando o mapa_status_por_horario)
-    horarios_finais_disponiveis = []
-    if barbeiro_selecionado == "Sem preferência":
-        # Mostra o horário se PELO MENOS UM barbeiro estiver disponível
-        for horario in horarios_para_exibir:
-            if any(status == "Disponível" for status in mapa_status_por_horario.get(horario, {}).values()):
-                horarios_finais_disponiveis.append(horario)
-    else:
-        # Mostra o horário apenas se O BARBEIRO ESCOLHIDO estiver disponível
-        for horario in horarios_para_exibir:
-            if mapa_status_por_horario.get(horario, {}).get(barbeiro_selecionado) == "Disponível":
-                horarios_finais_disponiveis.append(horario)
-
-    # 3. Exibição final do seletor de horário, agora com a lista filtrada
-    if not horarios_finais_disponiveis:
-        st.warning(f"Não há horários disponíveis para '{barbeiro_selecionado}' nesta data.")
-        horario_agendamento = None # Garante que o form não quebre se a lista estiver vazia
-    else:
-        horario_agendamento = st.selectbox("Horário", horarios_finais_disponiveis)
-    
+    st.write(f"Horário selecionado: **{horario_agendamento or '-'}**")
 
     servicos_selecionados = st.multiselect("Serviços", lista_servicos)
 
@@ -648,14 +1823,29 @@ with st.form("agendar_form"):
 
     submitted = st.form_submit_button("Confirmar Agendamento")
     
+# Nova chave de idempotência a cada formulário novo (depois de um agendamento concluído)
+if 'chave_formulario' not in st.session_state or (not submitted and st.session_state.get('formulario_concluido')):
+    st.session_state.chave_formulario = uuid.uuid4().hex
+    st.session_state.formulario_concluido = False
+    st.session_state.submissoes = {}  # Etapas (e a imagem) do formulário anterior não servem mais
 
 if submitted:
+    chave_idempotencia = gerar_chave_idempotencia(
+        st.session_state.chave_formulario, unidade_id_atual, data_agendamento_str_form,
+        horario_agendamento, barbeiro_selecionado, nome, telefone, sorted(servicos_selecionados),
+    )
+agendamento_anterior = etapa_concluida(chave_idempotencia, "agendamento") if submitted else None
+
+if agendamento_anterior:
+    # Toque repetido em "Confirmar Agendamento": nada de nova transação, e-mail ou imagem
+    concluir_agendamento(chave_idempotencia, agendamento_anterior)
+    st.session_state.formulario_concluido = True
+elif submitted:
     with st.spinner("Processando agendamento..."):
         # Usar o objeto date diretamente do session state para obter o dia da semana
         dia_da_semana_agendamento = data_obj_agendamento_form.weekday() # 0=Segunda, 6=Domingo
         dia = data_obj_agendamento_form.day
         mes = data_obj_agendamento_form.month
-        data_para_id = data_obj_agendamento_form.strftime('%Y-%m-%d')
         # >>> FIM DA MUDANÇA <<<
         
         if dia_da_semana_agendamento == 6:
@@ -670,8 +1860,8 @@ if submitted:
         # <<< FIM MODIFICAÇÃO 2 >>>
 
         # Validações básicas de preenchimento
-        if not nome or not telefone or not servicos_selecionados:
-            st.error("Por favor, preencha seu nome, telefone e selecione pelo menos um serviço.")
+        if not nome or not telefone or not servicos_selecionados or not horario_agendamento:
+            st.error("Por favor, preencha seu nome, telefone, escolha um horário e selecione pelo menos um serviço.")
             st.stop()
         if horario_agendamento in ["07:00", "07:30"]:
            dia = data_obj_agendamento_form.day
@@ -681,165 +1871,131 @@ if submitted:
             st.error("Os horários de 07:00 e 07:30 só estão disponíveis entre os dias 11 e 19 de julho.")
             st.stop()
 
-        # --- Validações de Horário de Almoço ---
-        intervalo_especial = mes == 7 and 10 <= dia <= 19
-        hora_agendamento_int = int(horario_agendamento.split(':')[0])
-        em_horario_de_almoco = (hora_agendamento_int == 12 or hora_agendamento_int == 13)
+        # --- Validação de Visagismo ---
+        servicos_visagismo = ["Abordagem de visagismo", "Consultoria de visagismo"]
+        visagismo_selecionado = any(servico in servicos_selecionados for servico in servicos_visagismo)
+        visagistas = [b for b in barbeiros if regras_barbeiros[b]["visagismo"]]
 
-        barbeiro_encontrado = None
-        
         # CASO 1: O USUÁRIO ESCOLHEU UM BARBEIRO ESPECÍFICO
         if barbeiro_selecionado != "Sem preferência":
-            # Regra 1: Verifica o bloqueio das 8:00 para o Lucas
-            if not intervalo_especial and horario_agendamento == "08:00" and barbeiro_selecionado == "Lucas Borges":
-                st.error("Lucas Borges não atende às 08:00. Por favor, escolha a partir das 08:30 ou selecione o barbeiro Aluizio.")
+            if visagismo_selecionado and barbeiro_selecionado not in visagistas:
+                st.error(f"Apenas {', '.join(visagistas)} realiza(m) atendimentos de visagismo. Por favor, selecione outro barbeiro ou remova o serviço de visagismo.")
                 st.stop()
-            
-            # Regra 2: Verifica o horário de almoço para o barbeiro selecionado
-            if not intervalo_especial and em_horario_de_almoco and dia_da_semana_agendamento < 5:
+
+            # Regras fixas do barbeiro (horários que não atende e almoço)
+            motivo = motivo_indisponibilidade(regras_barbeiros[barbeiro_selecionado], data_obj_agendamento_form, horario_agendamento)
+            if motivo == "Almoço":
                 st.error(f"{barbeiro_selecionado} está em horário de almoço. Por favor, escolha outro horário.")
                 st.stop()
-            
-            # Se passou nas regras, verifica a disponibilidade no banco de dados
-            chave_agendamento = f"{data_para_id}_{horario_agendamento}_{barbeiro_selecionado}"
-            chave_bloqueio = f"{chave_agendamento}_BLOQUEADO"
-            if (chave_agendamento not in agendamentos_do_dia) and (chave_bloqueio not in agendamentos_do_dia):
-                barbeiro_encontrado = barbeiro_selecionado
-        
-        # CASO 2: O USUÁRIO ESCOLHEU "SEM PREFERÊNCIA"
-        else:
-            barbeiros_a_verificar = ["Aluizio", "Lucas Borges"]  # Ordem de preferência
-            for b in barbeiros_a_verificar:
-                # Regra 1: Pula o Lucas se for 8:00 e não for intervalo especial
-                if not intervalo_especial and horario_agendamento == "08:00" and b == "Lucas Borges":
-                    continue  # Pula para o próximo barbeiro da lista
-
-                # Regra 2: Pula o barbeiro se ele estiver em horário de almoço
-                if not intervalo_especial and em_horario_de_almoco and dia_da_semana_agendamento < 5:
-                    continue # Pula para o próximo barbeiro da lista
-
-                # Se passou nas regras, verifica a disponibilidade no banco de dados
-                chave_agendamento = f"{data_para_id}_{horario_agendamento}_{b}"
-                chave_bloqueio = f"{chave_agendamento}_BLOQUEADO"
-                if (chave_agendamento not in agendamentos_do_dia) and (chave_bloqueio not in agendamentos_do_dia):
-                    barbeiro_encontrado = b  # Encontramos um barbeiro!
-                    st.info(f"Agendando com {barbeiro_encontrado}, o primeiro disponível.")
-                    break  # Sai do loop, pois não precisa procurar mais
+            elif motivo:
+                st.error(f"{barbeiro_selecionado} não atende às {horario_agendamento} nesta data. Por favor, escolha outro horário ou outro barbeiro.")
+                st.stop()
 
-        # --- Validação de Visagismo ---
-        servicos_visagismo = ["Abordagem de visagismo", "Consultoria de visagismo"]
-        visagismo_selecionado = any(servico in servicos_selecionados for servico in servicos_visagismo)
+            barbeiros_a_verificar = [barbeiro_selecionado]
 
-        if visagismo_selecionado and barbeiro_selecionado == "Aluizio":
-             st.error("Apenas Lucas Borges realiza atendimentos de visagismo. Por favor, selecione Lucas Borges ou remova o serviço de visagismo.")
-             st.stop()
-        # Se selecionou "Sem preferência" e visagismo, força a seleção para Lucas Borges
-        if visagismo_selecionado and barbeiro_selecionado == "Sem preferência":
-            barbeiro_final = "Lucas Borges"
-            st.info("Serviço de visagismo selecionado. Agendamento direcionado para Lucas Borges.")
-        elif barbeiro_selecionado != "Sem preferência":
-            barbeiro_final = barbeiro_selecionado
+        # CASO 2: O USUÁRIO ESCOLHEU "SEM PREFERÊNCIA"
         else:
-             barbeiro_final = None # Será definido abaixo
-
-        # --- Lógica de Atribuição e Verificação de Disponibilidade ---
-        barbeiros_a_verificar = []
-        if barbeiro_final: # Se já foi definido (Visagismo ou escolha específica)
-            barbeiros_a_verificar.append(barbeiro_final)
-        else: # Se for "Sem preferência" e sem visagismo
-            barbeiros_a_verificar = list(barbeiros) # Verifica ambos
+            candidatos = visagistas if visagismo_selecionado else barbeiros
+            if visagismo_selecionado:
+                st.info(f"Serviço de visagismo selecionado. Agendamento direcionado para: {', '.join(visagistas)}.")
+            candidatos = [
+                b for b in candidatos
+                if motivo_indisponibilidade(regras_barbeiros[b], data_obj_agendamento_form, horario_agendamento) is None
+            ]
+            # O menos ocupado do dia vem primeiro, para distribuir os clientes
+            barbeiros_a_verificar = ordenar_barbeiros_por_carga(candidatos, agendamentos_do_dia)
+            # Se o cliente já segura uma reserva neste horário, tenta primeiro esse barbeiro
+            reserva_atual = st.session_state.get('reserva_atual')
+            if reserva_atual and reserva_atual['alvo'][1:3] == (data_para_id_form, horario_agendamento) and reserva_atual['alvo'][3] in barbeiros_a_verificar:
+                barbeiros_a_verificar.remove(reserva_atual['alvo'][3])
+                barbeiros_a_verificar.insert(0, reserva_atual['alvo'][3])
 
 # DEPOIS (CORRETO)
         barbeiro_agendado = None
-# A data já está como objeto em data_obj_agendamento_form
-        data_para_id_form = data_obj_agendamento_form.strftime('%Y-%-m-%d')
 
-        intervalo_especial = False
-        if dia_da_semana_agendamento < 5:
-            intervalo_especial = (mes == 7 and 10 <= dia <= 19)
-            
-        for b in barbeiros_a_verificar:
-            if not intervalo_especial:
-                if b == "Lucas Borges" and (hora_agendamento_int == 12 or hora_agendamento_int == 13):
-                    continue # Pula este barbeiro se estiver em almoço
-                if b == "Aluizio" and (hora_agendamento_int == 12 or hora_agendamento_int == 13):
-                    continue # Pula este barbeiro se estiver em almoço
-
-            chave_agendamento_form = f"{data_para_id_form}_{horario_agendamento}_{b}"
-            chave_bloqueio_form = f"{chave_agendamento_form}_BLOQUEADO"
-
-    # Verifica de forma instantânea no conjunto que já foi carregado
-            if (chave_agendamento_form not in agendamentos_do_dia) and (chave_bloqueio_form not in agendamentos_do_dia):
-                barbeiro_agendado = b
-                break # Encontrou um barbeiro disponível
-
-# O resto do seu código a partir daqui continua igual...
-        if not barbeiro_agendado:
-            st.error(f"Horário {horario_agendamento} indisponível para os barbeiros selecionados/disponíveis. Por favor, escolha outro horário ou verifique a tabela de disponibilidade.")
-            st.stop()
+        chave_horario_admitido = None
+        recusado_pela_fila = False
 
-        # --- Verificação de Horário Seguinte para Corte+Barba ---
-        precisa_bloquear_proximo = False
-        corte_selecionado = any(corte in servicos_selecionados for corte in ["Tradicional", "Social", "Degradê", "Navalhado"])
-        barba_selecionada = "Barba" in servicos_selecionados
+        # A vaga admitida é devolvida em qualquer saída (st.stop(), erro ou
+        # RerunException de um segundo toque), não só nos caminhos esperados
+        agendamento_salvo = False
+        try:
+            for b in barbeiros_a_verificar:
+                indice_form = codec_unidade.codificar(data_obj_agendamento_form, horario_agendamento, b)
 
-        if corte_selecionado and barba_selecionada:
-            if not verificar_disponibilidade_horario_seguinte(data_agendamento_str_form, horario_agendamento, barbeiro_agendado):
-                horario_seguinte_dt = datetime.strptime(horario_agendamento, '%H:%M') + timedelta(minutes=30)
-                horario_seguinte_str = horario_seguinte_dt.strftime('%H:%M')
-                st.error(f"O barbeiro {barbeiro_agendado} não poderá atender para corte e barba, pois já está ocupado no horário seguinte ({horario_seguinte_str}). Por favor, escolha serviços que caibam em 30 minutos ou selecione outro horário/barbeiro.")
+        # Verifica de forma instantânea no conjunto que já foi carregado
+                # (inclusive reservas ativas de outras sessões, que a transação recusaria)
+                reservado_por_outro = reserva_ativa(
+                    ocupados_do_dia.get(indice_form + codec_unidade.deslocamento[RESERVA]),
+                    st.session_state.id_sessao,
+                )
+                if (indice_form not in ocupados_do_dia) and (indice_form + codec_unidade.deslocamento[BLOQUEADO] not in ocupados_do_dia) and not reservado_por_outro:
+                    # Só uma sessão por vez grava o mesmo horário; as demais tentam o próximo barbeiro
+                    chave_horario = (unidade_id_atual, data_para_id_form, horario_agendamento, b)
+                    if not admitir_horario(chave_horario):
+                        recusado_pela_fila = True
+                        continue
+                    chave_horario_admitido = chave_horario
+                    barbeiro_agendado = b
+                    break # Encontrou um barbeiro disponível
+
+    # O resto do seu código a partir daqui continua igual...
+            if not barbeiro_agendado and recusado_pela_fila:
+                alternativas = horarios_alternativos(horario_agendamento, horarios_finais_disponiveis)
+                st.error(f"O horário {horario_agendamento} acabou de ser reservado por outro cliente.")
+                if alternativas:
+                    st.info(f"Horários livres mais próximos: {', '.join(alternativas)}.")
                 st.stop()
-            else:
-                precisa_bloquear_proximo = True
+            if not barbeiro_agendado:
+                st.error(f"Horário {horario_agendamento} indisponível para os barbeiros selecionados/disponíveis. Por favor, escolha outro horário ou verifique a tabela de disponibilidade.")
+                st.stop()
+            if barbeiro_selecionado == "Sem preferência":
+                st.info(f"Agendando com {barbeiro_agendado}, o barbeiro com a agenda mais livre no dia.")
+
+            # --- Verificação de Horário Seguinte para Corte+Barba ---
+            precisa_bloquear_proximo = False
+            corte_selecionado = any(corte in servicos_selecionados for corte in ["Tradicional", "Social", "Degradê", "Navalhado"])
+            barba_selecionada = "Barba" in servicos_selecionados
+
+            if corte_selecionado and barba_selecionada:
+                # Primeiro pelo mapa do dia, em memória; o Firestore só é consultado se ali estiver livre
+                indice_seguinte = codec_unidade.seguinte(codec_unidade.codificar(data_obj_agendamento_form, horario_agendamento, barbeiro_agendado))
+                seguinte_livre_no_mapa = (
+                    indice_seguinte is not None
+                    and indice_seguinte not in ocupados_do_dia
+                    and indice_seguinte + codec_unidade.deslocamento[BLOQUEADO] not in ocupados_do_dia
+                )
+                if not seguinte_livre_no_mapa or not verificar_disponibilidade_horario_seguinte(data_agendamento_str_form, horario_agendamento, barbeiro_agendado, unidade_id_atual):
+                    horario_seguinte_str = chaves.horario_seguinte(horario_agendamento) or "20:00"
+                    st.error(f"O barbeiro {barbeiro_agendado} não poderá atender para corte e barba, pois já está ocupado no horário seguinte ({horario_seguinte_str}). Por favor, escolha serviços que caibam em 30 minutos ou selecione outro horário/barbeiro.")
+                    st.stop()
+                else:
+                    precisa_bloquear_proximo = True
 
-        # --- Salvar Agendamento e Bloquear (se necessário) ---
-        agendamento_salvo = salvar_agendamento(data_agendamento_str_form, horario_agendamento, nome, telefone, servicos_selecionados, barbeiro_agendado)
+            # --- Salvar Agendamento e Bloquear (se necessário) ---
+            agendamento_salvo = salvar_agendamento(data_agendamento_str_form, horario_agendamento, nome, telefone, servicos_selecionados, barbeiro_agendado, unidade_id_atual, st.session_state.id_sessao)
+        finally:
+            if chave_horario_admitido:
+                liberar_horario(chave_horario_admitido, confirmado=agendamento_salvo)
 
+        # A partir daqui, um segundo toque no botão só conclui/reexibe este agendamento
         if agendamento_salvo:
-            horario_seguinte_bloqueado = False
-            if precisa_bloquear_proximo:
-                horario_seguinte_dt = datetime.strptime(horario_agendamento, '%H:%M') + timedelta(minutes=30)
-                horario_seguinte_str = horario_seguinte_dt.strftime('%H:%M')
-                horario_seguinte_bloqueado = bloquear_horario(data_agendamento_str_form, horario_seguinte_str, barbeiro_agendado)
-                if not horario_seguinte_bloqueado:
-                     st.warning("O agendamento principal foi salvo, mas houve um erro ao bloquear o horário seguinte. Por favor, entre em contato com a barbearia se necessário.")
-
-
-            # --- Preparar e Enviar E-mail ---
-            resumo = f"""
-            Nome: {nome}
-            Telefone: {telefone}
-            Data: {data_agendamento_str_form}
-            Horário: {horario_agendamento}
-            Barbeiro: {barbeiro_agendado}
-            Serviços: {', '.join(servicos_selecionados)}
-            """
-            enviar_email("Agendamento Confirmado", resumo)
-
-            # --- Mensagem de Sucesso e Rerun ---
-            st.success("Agendamento confirmado com sucesso!")
-            st.info("Resumo do agendamento:\n" + resumo)
-            if horario_seguinte_bloqueado:
-                st.info(f"O horário das {horario_seguinte_str} com {barbeiro_agendado} foi bloqueado para acomodar todos os serviços.")
-            
-            # ### INÍCIO DA MODIFICAÇÃO ###
-            # Chama a função para gerar a imagem com os dados do agendamento
-            imagem_bytes = gerar_imagem_resumo(
-                nome=nome,
-                data=data_agendamento_str_form,
-                horario=horario_agendamento,
-                barbeiro=barbeiro_agendado,
-                servicos=servicos_selecionados
-            )
-
-            # Se a imagem foi gerada corretamente, mostra o botão de download
-            if imagem_bytes:
-                st.download_button(
-                    label="📥 Baixar Resumo do Agendamento",
-                    data=imagem_bytes,
-                    file_name=f"agendamento_{nome.split(' ')[0]}_{data_agendamento_str_form.replace('/', '-')}.png",
-                    mime="image/png"
-                )
+            agendamento = {
+                'unidade_id': unidade_id_atual,
+                'data': data_agendamento_str_form,
+                'horario': horario_agendamento,
+                'nome': nome,
+                'telefone': telefone,
+                'servicos': servicos_selecionados,
+                'barbeiro': barbeiro_agendado,
+                'precisa_bloquear_proximo': precisa_bloquear_proximo,
+            }
+            registrar_etapa(chave_idempotencia, "agendamento", agendamento)
+            st.session_state.reserva_atual = None  # A reserva virou agendamento
+            concluir_agendamento(chave_idempotencia, agendamento)
+            st.session_state.formulario_concluido = True
+
+            exibir_relatorio_de_perfil()
             st.info("A página será atualizada em 15 segundos.")
             time.sleep(15) 
             st.rerun()
@@ -856,7 +2012,7 @@ with st.form("cancelar_form"):
     data_cancelar = st.date_input("Data do Agendamento", min_value=datetime.today().date()) # Usar date()
 
     # Geração da lista de horários completa para cancelamento
-    horarios_base_cancelamento = [f"{h:02d}:{m:02d}" for h in range(8, 20) for m in (0, 30)]
+    horarios_base_cancelamento = chaves.HORARIOS_GRADE
 
     horario_cancelar = st.selectbox("Horário do Agendamento", horarios_base_cancelamento) # Usa a lista completa
 
@@ -868,13 +2024,15 @@ if submitted_cancelar:
         st.error("Por favor, informe o telefone utilizado no agendamento.")
     else:
         with st.spinner("Processando cancelamento..."):
-            data_para_id = data_cancelar.strftime('%Y-%m-%d')
-            doc_id_cancelar = f"{data_para_id}_{horario_cancelar}_{barbeiro_cancelar}"
+            data_para_id = chaves.chave_data(data_cancelar)
+            doc_id_cancelar = chave_documento(data_para_id, horario_cancelar, barbeiro_cancelar)
 
-            resultado_cancelamento = cancelar_agendamento(doc_id_cancelar, telefone_cancelar)
+            resultado_cancelamento = cancelar_agendamento(doc_id_cancelar, telefone_cancelar, unidade_id_atual)
 
             if isinstance(resultado_cancelamento, dict):
                 agendamento_cancelado_data = resultado_cancelamento
+                # O horário volta a aceitar submissões imediatamente
+                liberar_horario((unidade_id_atual, data_para_id, horario_cancelar, barbeiro_cancelar))
                 servicos_cancelados = agendamento_cancelado_data.get('servicos', [])
                 corte_no_cancelado = any(corte in servicos_cancelados for corte in ["Tradicional", "Social", "Degradê", "Navalhado"])
                 barba_no_cancelado = "Barba" in servicos_cancelados
@@ -885,16 +2043,16 @@ if submitted_cancelar:
                     barbeiro_original = agendamento_cancelado_data['barbeiro']
                     data_obj_original = agendamento_cancelado_data['data']
 
-                    horario_seguinte_dt = (datetime.strptime(horario_agendamento_original, '%H:%M') + timedelta(minutes=30))
-                    if horario_seguinte_dt.hour < 20:
-                        horario_seguinte_str = horario_seguinte_dt.strftime('%H:%M')
-                        data_para_id_desbloqueio = data_obj_original.strftime('%Y-%m-%d')
-                        desbloquear_horario(data_para_id_desbloqueio, horario_seguinte_str, barbeiro_original)
+                    horario_seguinte_str = chaves.horario_seguinte(horario_agendamento_original)
+                    if horario_seguinte_str is not None:
+                        data_para_id_desbloqueio = chaves.chave_data(data_obj_original)
+                        desbloquear_horario(data_para_id_desbloqueio, horario_seguinte_str, barbeiro_original, unidade_id_atual)
                         horario_seguinte_desbloqueado = True
 
         # --- A sua lógica de E-mail e Mensagem de Sucesso (MANTIDA) ---
                 resumo_cancelamento = f"""
                 Agendamento Cancelado:
+                Unidade: {unidade_atual['nome']}
                 Nome: {agendamento_cancelado_data.get('nome', 'N/A')}
                 Telefone: {agendamento_cancelado_data.get('telefone', 'N/A')}
                 Data: {data_cancelar.strftime('%d/%m/%Y')}
@@ -902,16 +2060,49 @@ if submitted_cancelar:
                 Barbeiro: {agendamento_cancelado_data.get('barbeiro', 'N/A')}
                 Serviços: {', '.join(agendamento_cancelado_data.get('servicos', []))}
                 """
-                enviar_email("Agendamento Cancelado", resumo_cancelamento)
+                enviar_email(f"Agendamento Cancelado - {unidade_atual['nome']}", resumo_cancelamento)
         
                 st.success("Agendamento cancelado com sucesso!")
                 if horario_seguinte_desbloqueado:
                     st.info("O horário seguinte, que estava bloqueado, foi liberado.")
         
+                exibir_relatorio_de_perfil()
                 time.sleep(5)
                 st.rerun()
-                
-
 
+# Saúde dos canais do Firestore (modo administrador)
+if modo_admin:
+    with st.expander("Conexões com o Firestore"):
+        st.caption(f"{FIRESTORE_CANAIS} canal(is), keepalive de {FIRESTORE_KEEPALIVE_MS} ms. Esta sessão usa o canal {st.session_state.get('canal_firestore', 0)}.")
+        st.dataframe(resumo_saude_firestore(), hide_index=True)
+
+# Importação de agendamentos em lote (modo administrador)
+if modo_admin:
+    with st.expander("Importar agendamentos (CSV/XLSX)"):
+        st.caption(f"Colunas: {', '.join(IMPORTACAO_COLUNAS)}. Data em dd/mm/aaaa, horário em hh:mm e serviços separados por vírgula.")
+        arquivo_importacao = st.file_uploader("Planilha", type=["csv", "xlsx"])
+        if arquivo_importacao and st.button("Importar agendamentos"):
+            try:
+                if arquivo_importacao.name.lower().endswith(".xlsx"):
+                    planilha = pd.read_excel(arquivo_importacao, dtype=str)
+                else:
+                    planilha = pd.read_csv(arquivo_importacao, dtype=str, sep=None, engine="python")
+            except ImportError:
+                st.error("Para importar arquivos .xlsx é preciso instalar o pacote 'openpyxl'.")
+                st.stop()
+            except Exception as e:
+                st.error(f"Não foi possível ler a planilha: {e}")
+                st.stop()
 
+            planilha.columns = [str(coluna).strip().lower() for coluna in planilha.columns]
+            colunas_faltando = [coluna for coluna in IMPORTACAO_COLUNAS if coluna not in planilha.columns]
+            if colunas_faltando:
+                st.error(f"Colunas faltando na planilha: {', '.join(colunas_faltando)}")
+            else:
+                with st.spinner("Importando agendamentos..."):
+                    relatorio_importacao = importar_agendamentos(planilha, unidade_id_atual)
+                importados = (relatorio_importacao["resultado"] == "Importado").sum()
+                st.success(f"{importados} de {len(relatorio_importacao)} agendamento(s) importado(s).")
+                st.dataframe(relatorio_importacao[relatorio_importacao["resultado"] != "Importado"], hide_index=True)
 
+exibir_relatorio_de_perfil()